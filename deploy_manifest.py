@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import threading
+
+import botocore.exceptions
+
+# Where the hashes of the objects deployed to each bucket are kept between runs
+MANIFEST_DIR = os.getenv("DEPLOY_MANIFEST_DIR", ".deploy")
+
+# Key of the copy of the manifest kept in the bucket itself, for deploys from a
+# fresh checkout like a CI runner
+MANIFEST_KEY = os.getenv("DEPLOY_MANIFEST_KEY", ".deploy/manifest.json")
+
+
+class DeployManifest(object):
+    """
+    Content hashes of the objects deployed to a bucket.
+
+    The hash of an object covers the uploaded file and its upload arguments
+    (content type, content encoding, ACL), so an object is current when it would
+    be uploaded exactly as the last time.
+
+    Given an s3 client, the manifest is also saved in the bucket under
+    MANIFEST_KEY and read from there first, so deploys from any checkout share
+    it. Otherwise only the local copy is used, which a fresh checkout doesn't
+    have. Changes made to the bucket by other means aren't noticed either, a
+    deploy without sync uploads everything again.
+    """
+
+    def __init__(self, name, s3=None, bucket=None):
+        self.path = os.path.join(MANIFEST_DIR, name + ".json")
+        self.s3 = s3
+        self.bucket = bucket
+
+        self.hashes = self.load_remote() if s3 is not None else None
+        if self.hashes is None:
+            try:
+                with open(self.path) as f:
+                    self.hashes = json.load(f)
+            except (OSError, ValueError):
+                self.hashes = {}
+        # The objects of this deploy, the others are stale unless kept
+        self.updated = {}
+
+    def load_remote(self):
+        """Return the hashes saved in the bucket, or None if there are none"""
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=MANIFEST_KEY)
+            return json.loads(response["Body"].read())
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("NoSuchKey", "404"):
+                print(f"WARNING: Unable to read the deploy manifest: {e}")
+        except (botocore.exceptions.BotoCoreError, ValueError) as e:
+            print(f"WARNING: Unable to read the deploy manifest: {e}")
+        return None
+
+    def digest(self, filename, extra_args):
+        digest = hashlib.sha256(json.dumps(extra_args, sort_keys=True).encode("utf-8"))
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def is_current(self, key, digest):
+        return self.hashes.get(key) == digest
+
+    def update(self, key, digest):
+        self.updated[key] = digest
+
+    def stale_keys(self):
+        """Keys deployed before whose object wasn't part of this deploy"""
+        return sorted(set(self.hashes) - set(self.updated))
+
+    def save(self, keep=()):
+        """Save the objects of this deploy, plus the earlier ones in keep"""
+        hashes = dict(self.updated)
+        for key in keep:
+            hashes[key] = self.hashes[key]
+
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        tmp_path = "{}.{}.{}".format(self.path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "w") as f:
+            json.dump(hashes, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+        if self.s3 is not None:
+            try:
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=MANIFEST_KEY,
+                    Body=json.dumps(hashes, sort_keys=True).encode("utf-8"),
+                    ContentType="application/json",
+                )
+            except (
+                botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError,
+            ) as e:
+                print(f"WARNING: Unable to save the deploy manifest: {e}")
@@ -1,6 +1,5 @@
-import mako.template
-import mako.lookup
 import mako.exceptions
+import concurrent.futures
 import io
 import json
 import datetime
@@ -10,6 +9,12 @@ import bisect
 import yaml
 import re
 
+from detail_pages_manifest import PageManifest
+from template_registry import get_template
+
+# Number of processes rendering the detail pages, 1 renders them in this process
+DETAIL_PAGE_PROCESSES = int(os.getenv("DETAIL_PAGE_PROCESSES", "1"))
+
 
 def initial_prices(i):
     # For EC2, basically everything has a price for linux, on-demand in us-east-1
@@ -316,56 +321,142 @@ def map_ec2_attributes(i, imap):
     return instance_details
 
 
-def build_detail_pages_ec2(instances, all_regions):
-    subdir = os.path.join("www", "aws", "ec2")
+TEMPLATE_FILE = "in/instance-type.html.mako"
 
-    ifam, fam_lookup, variants = assemble_the_families(instances)
-    imap = load_service_attributes()
 
-    lookup = mako.lookup.TemplateLookup(directories=["."])
-    template = mako.template.Template(
-        filename="in/instance-type.html.mako", lookup=lookup
+def load_template():
+    return get_template(TEMPLATE_FILE)
+
+
+def render_instance_page(template, i, context):
+    """
+    Render the detail page of one instance, returns (page, error, digest). In
+    incremental mode the page is left alone when its inputs are unchanged.
+    """
+    ifam, fam_lookup, variants, imap, all_regions, subdir, manifest, incremental = (
+        context
+    )
+    instance_type = i["instance_type"]
+
+    instance_page = os.path.join(subdir, instance_type + ".html")
+    fam = fam_lookup[instance_type]
+    fam_members = ifam[fam]
+
+    digest = manifest.page_hash(
+        i, fam_members, variants.get(instance_type[0:2]), all_regions
     )
+    if incremental and manifest.is_current(instance_page, digest):
+        return instance_page, None, digest
+
+    instance_details = map_ec2_attributes(i, imap)
+    instance_details["Pricing"] = prices(i["pricing"])
+    instance_details["Storage"].extend(storage(i["storage"], imap))
+    denylist = unavailable_instances(instance_details, all_regions)
+    defaults = initial_prices(instance_details)
+    idescription = description(instance_details, defaults)
+
+    print("Rendering %s to detail page %s..." % (instance_type, instance_page))
+    with io.open(instance_page, "w+", encoding="utf-8") as fh:
+        try:
+            fh.write(
+                template.render(
+                    i=instance_details,
+                    family=fam_members,
+                    description=idescription,
+                    unavailable=denylist,
+                    defaults=defaults,
+                    variants=variants[instance_type[0:2]],
+                    regions=all_regions,
+                )
+            )
+            return instance_page, None, digest
+        except:
+            render_err = mako.exceptions.text_error_template().render()
+            return None, {"e": "ERROR for " + instance_type, "t": render_err}, None
 
-    # To add more data to a single instance page, do so inside this loop
+
+def render_instance_pages(template, instances, context):
     could_not_render = []
     sitemap = []
+    page_hashes = {}
     for i in instances:
-        instance_type = i["instance_type"]
         # Use this to debug individual instances
-        # if instance_type != "t4g.nano":
+        # if i["instance_type"] != "t4g.nano":
         #     continue
+        instance_page, err, digest = render_instance_page(template, i, context)
+        if err:
+            could_not_render.append(err)
+        else:
+            sitemap.append(instance_page)
+            page_hashes[instance_page] = digest
+    return sitemap, could_not_render, page_hashes
 
-        instance_page = os.path.join(subdir, instance_type + ".html")
-        instance_details = map_ec2_attributes(i, imap)
-        instance_details["Pricing"] = prices(i["pricing"])
-        instance_details["Storage"].extend(storage(i["storage"], imap))
-        fam = fam_lookup[instance_type]
-        fam_members = ifam[fam]
-        denylist = unavailable_instances(instance_details, all_regions)
-        defaults = initial_prices(instance_details)
-        idescription = description(instance_details, defaults)
-
-        print("Rendering %s to detail page %s..." % (instance_type, instance_page))
-        with io.open(instance_page, "w+", encoding="utf-8") as fh:
-            try:
-                fh.write(
-                    template.render(
-                        i=instance_details,
-                        family=fam_members,
-                        description=idescription,
-                        unavailable=denylist,
-                        defaults=defaults,
-                        variants=variants[instance_type[0:2]],
-                        regions=all_regions,
-                    )
-                )
-                sitemap.append(instance_page)
-            except:
-                render_err = mako.exceptions.text_error_template().render()
-                err = {"e": "ERROR for " + instance_type, "t": render_err}
 
-                could_not_render.append(err)
+# Set in each worker process by init_worker()
+_worker_template = None
+_worker_context = None
+
+
+def init_worker(context):
+    global _worker_template, _worker_context
+    # Load the template once per worker rather than once per shard
+    _worker_template = load_template()
+    _worker_context = context
+
+
+def render_shard(instances):
+    return render_instance_pages(_worker_template, instances, _worker_context)
+
+
+def build_detail_pages_ec2(
+    instances, all_regions, processes=DETAIL_PAGE_PROCESSES, incremental=False
+):
+    subdir = os.path.join("www", "aws", "ec2")
+
+    ifam, fam_lookup, variants = assemble_the_families(instances)
+    imap = load_service_attributes()
+    manifest = PageManifest(
+        "ec2", [TEMPLATE_FILE, "meta/service_attributes_ec2.csv", __file__]
+    )
+    context = (
+        ifam,
+        fam_lookup,
+        variants,
+        imap,
+        all_regions,
+        subdir,
+        manifest,
+        incremental,
+    )
+
+    # To add more data to a single instance page, do so in render_instance_page
+    if processes <= 1:
+        sitemap, could_not_render, page_hashes = render_instance_pages(
+            load_template(), instances, context
+        )
+    else:
+        # Contiguous shards, a few per process to even out the load, so the
+        # sitemap keeps the order of the instances
+        shard_size = max(1, -(-len(instances) // (processes * 4)))
+        shards = [
+            instances[n : n + shard_size] for n in range(0, len(instances), shard_size)
+        ]
+        could_not_render = []
+        sitemap = []
+        page_hashes = {}
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes, initializer=init_worker, initargs=(context,)
+        ) as executor:
+            for shard_sitemap, shard_errors, shard_hashes in executor.map(
+                render_shard, shards
+            ):
+                sitemap.extend(shard_sitemap)
+                could_not_render.extend(shard_errors)
+                page_hashes.update(shard_hashes)
+
+    for page, digest in page_hashes.items():
+        manifest.update(page, digest)
+    manifest.save()
 
     [print(err["e"], "{}".format(err["t"])) for err in could_not_render]
     [print(page["e"]) for page in could_not_render]
@@ -0,0 +1,56 @@
+import hashlib
+import json
+import os
+import threading
+
+# Where the hashes of the inputs of the rendered detail pages are kept between runs
+MANIFEST_DIR = os.getenv("DETAIL_PAGES_MANIFEST_DIR", ".detail_pages")
+
+
+class PageManifest(object):
+    """
+    Content hashes of the inputs of each rendered detail page of a service.
+
+    A page hash covers everything the page is rendered from: the instance, its
+    family members and variants, the regions, plus the template, the service
+    attributes and the code rendering it (the sources). In incremental mode a
+    page is only rendered again when its hash changed or the page is missing.
+    """
+
+    def __init__(self, name, sources):
+        self.path = os.path.join(MANIFEST_DIR, name + ".json")
+
+        sources_hash = hashlib.sha256()
+        for source in sources:
+            with open(source, "rb") as f:
+                sources_hash.update(f.read())
+        self.sources_digest = sources_hash.hexdigest()
+
+        try:
+            with open(self.path) as f:
+                self.hashes = json.load(f)
+        except (OSError, ValueError):
+            self.hashes = {}
+        # Only the pages of this run are saved, so removed pages drop out
+        self.updated = {}
+
+    def page_hash(self, *inputs):
+        page_hash = hashlib.sha256(self.sources_digest.encode("utf-8"))
+        # Inputs are hashed in order, as the order of their regions, family
+        # members and pricing is the order they are rendered in
+        inputs_json = json.dumps(inputs, default=str)
+        page_hash.update(inputs_json.encode("utf-8"))
+        return page_hash.hexdigest()
+
+    def is_current(self, page, digest):
+        return self.hashes.get(page) == digest and os.path.exists(page)
+
+    def update(self, page, digest):
+        self.updated[page] = digest
+
+    def save(self):
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        tmp_path = "{}.{}.{}".format(self.path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "w") as f:
+            json.dump(self.updated, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -1,5 +1,3 @@
-import mako.template
-import mako.lookup
 import mako.exceptions
 import io
 import json
@@ -10,6 +8,9 @@ import bisect
 import yaml
 import re
 
+from detail_pages_manifest import PageManifest
+from template_registry import get_template
+
 
 rds_engine_mapping = {
     "2": "MySQL",
@@ -314,15 +315,17 @@ def map_rds_attributes(i, imap):
     return instance_details
 
 
-def build_detail_pages_rds(instances, all_regions):
+def build_detail_pages_rds(instances, all_regions, incremental=False):
     subdir = os.path.join("www", "aws", "rds")
+    template_file = "in/instance-type-rds.html.mako"
 
     ifam, fam_lookup, variants = assemble_the_families(instances)
     imap = load_service_attributes()
 
-    lookup = mako.lookup.TemplateLookup(directories=["."])
-    template = mako.template.Template(
-        filename="in/instance-type-rds.html.mako", lookup=lookup
+    template = get_template(template_file)
+    manifest = PageManifest(
+        "rds",
+        [template_file, "meta/service_attributes_rds.csv", __file__],
     )
 
     # To add more data to a single instance page, do so inside this loop
@@ -331,10 +334,19 @@ def build_detail_pages_rds(instances, all_regions):
     for i in instances:
         instance_type = i["instance_type"]
         instance_page = os.path.join(subdir, instance_type + ".html")
-        instance_details = map_rds_attributes(i, imap)
-        instance_details["Pricing"] = prices(i["pricing"])
         fam = fam_lookup[instance_type]
         fam_members = ifam[fam]
+
+        digest = manifest.page_hash(
+            i, fam_members, variants.get(instance_type[3:5]), all_regions
+        )
+        if incremental and manifest.is_current(instance_page, digest):
+            manifest.update(instance_page, digest)
+            sitemap.append(instance_page)
+            continue
+
+        instance_details = map_rds_attributes(i, imap)
+        instance_details["Pricing"] = prices(i["pricing"])
         denylist = unavailable_instances(instance_details, all_regions)
         defaults = initial_prices(instance_details, instance_type)
         idescription = description(instance_details, defaults)
@@ -353,6 +365,7 @@ def build_detail_pages_rds(instances, all_regions):
                         regions=all_regions,
                     )
                 )
+                manifest.update(instance_page, digest)
                 sitemap.append(instance_page)
             except:
                 render_err = mako.exceptions.text_error_template().render()
@@ -361,6 +374,8 @@ def build_detail_pages_rds(instances, all_regions):
                 could_not_render.append(err)
         # break
 
+    manifest.save()
+
     [print(err["e"], "{}".format(err["t"])) for err in could_not_render]
     [print(page["e"]) for page in could_not_render]
 
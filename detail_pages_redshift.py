@@ -1,5 +1,3 @@
-import mako.template
-import mako.lookup
 import mako.exceptions
 import io
 import json
@@ -10,6 +8,9 @@ import bisect
 import yaml
 import re
 
+from detail_pages_manifest import PageManifest
+from template_registry import get_template
+
 
 def initial_prices(i, instance_type):
     try:
@@ -243,15 +244,17 @@ def map_cache_attributes(i, imap):
     return instance_details
 
 
-def build_detail_pages_redshift(instances, all_regions):
+def build_detail_pages_redshift(instances, all_regions, incremental=False):
     subdir = os.path.join("www", "aws", "redshift")
+    template_file = "in/instance-type-redshift.html.mako"
 
     ifam, fam_lookup, variants = assemble_the_families(instances)
     imap = load_service_attributes()
 
-    lookup = mako.lookup.TemplateLookup(directories=["."])
-    template = mako.template.Template(
-        filename="in/instance-type-redshift.html.mako", lookup=lookup
+    template = get_template(template_file)
+    manifest = PageManifest(
+        "redshift",
+        [template_file, "meta/service_attributes_redshift.csv", __file__],
     )
 
     # To add more data to a single instance page, do so inside this loop
@@ -259,12 +262,20 @@ def build_detail_pages_redshift(instances, all_regions):
     sitemap = []
     for i in instances:
         instance_type = i["instance_type"]
-
         instance_page = os.path.join(subdir, instance_type + ".html")
-        instance_details = map_cache_attributes(i, imap)
-        instance_details["Pricing"] = prices(i["pricing"])
         fam = fam_lookup[instance_type]
         fam_members = ifam[fam]
+
+        digest = manifest.page_hash(
+            i, fam_members, variants.get(instance_type[0:2]), all_regions
+        )
+        if incremental and manifest.is_current(instance_page, digest):
+            manifest.update(instance_page, digest)
+            sitemap.append(instance_page)
+            continue
+
+        instance_details = map_cache_attributes(i, imap)
+        instance_details["Pricing"] = prices(i["pricing"])
         denylist = unavailable_instances(instance_details, all_regions)
         defaults = initial_prices(instance_details, instance_type)
         idescription = description(instance_details, defaults)
@@ -283,6 +294,7 @@ def build_detail_pages_redshift(instances, all_regions):
                         regions=all_regions,
                     )
                 )
+                manifest.update(instance_page, digest)
                 sitemap.append(instance_page)
             except:
                 render_err = mako.exceptions.text_error_template().render()
@@ -290,6 +302,8 @@ def build_detail_pages_redshift(instances, all_regions):
 
                 could_not_render.append(err)
 
+    manifest.save()
+
     [print(err["e"], "{}".format(err["t"])) for err in could_not_render]
     [print(page["e"]) for page in could_not_render]
 
@@ -1,12 +1,16 @@
 import botocore
 import botocore.exceptions
 import boto3
+import concurrent.futures
 from datetime import datetime
+import http_cache
 import locale
 import json
 from pkg_resources import resource_filename
+import offer_file
 import re
 import scrape
+import threading
 import traceback
 
 
@@ -18,7 +22,19 @@ def canonicalize_location(location, from_pricing_api=True):
     return re.sub("^EU", "Europe", location)
 
 
-def create_boto3_client(service_name, region_name="us-east-1", max_retries=50):
+_thread_local = threading.local()
+
+
+def get_boto3_session():
+    """Return a boto3 session for the calling thread, creating it on first use"""
+    if not hasattr(_thread_local, "session"):
+        _thread_local.session = boto3.session.Session()
+    return _thread_local.session
+
+
+def create_boto3_client(
+    service_name, region_name="us-east-1", max_retries=50, session=None
+):
     """
     Create a boto3 client with exponential backoff configuration.
 
@@ -26,6 +42,8 @@ def create_boto3_client(service_name, region_name="us-east-1", max_retries=50):
     - service_name: AWS service to connect to (e.g., 'ec2', 'pricing')
     - region_name: AWS region (default: 'us-east-1')
     - max_retries: Maximum number of retry attempts (default: 15)
+    - session: boto3 session to create the client from (default: a session
+      private to the calling thread, since boto3 sessions aren't thread safe)
 
     Returns:
     - Configured boto3 client
@@ -40,7 +58,9 @@ def create_boto3_client(service_name, region_name="us-east-1", max_retries=50):
         read_timeout=60,  # Increase read timeout
     )
 
-    return boto3.client(service_name, region_name=region_name, config=config)
+    if session is None:
+        session = get_boto3_session()
+    return session.client(service_name, region_name=region_name, config=config)
 
 
 # Translate between the API and what is used locally
@@ -106,7 +126,12 @@ def get_region_descriptions():
     return result
 
 
-def get_instances():
+def describe_instance_types():
+    """Return the full DescribeInstanceTypes listing, indexed by instance type
+
+    This is the most expensive EC2 API listing we use, so fetch it once and hand
+    the result to every stage that needs it.
+    """
     instance_types = {}
     try:
         ec2_client = create_boto3_client("ec2", region_name="us-east-1")
@@ -120,6 +145,25 @@ def get_instances():
             f"ERROR: Failure listing EC2 instance types. See README for proper IAM permissions.\n{e}"
         )
         raise e
+    return instance_types
+
+
+# The instances found by the last get_instances() call, reused by other scrapers
+_instances = None
+
+
+def get_cached_instances():
+    """Return the instances of an earlier get_instances() call, or scrape them now"""
+    if _instances is None:
+        get_instances()
+    return _instances
+
+
+def get_instances(instance_types=None):
+    global _instances
+
+    if instance_types is None:
+        instance_types = describe_instance_types()
 
     instances = {}
     pricing_client = create_boto3_client("pricing", region_name="us-east-1")
@@ -174,76 +218,129 @@ def get_instances():
                     instances[instance_type] = new_inst
 
     print(f"Found data for instance types: {', '.join(sorted(instances.keys()))}")
-    return list(instances.values())
+    _instances = list(instances.values())
+    return _instances
 
 
-def add_pricing(imap):
+# The attribute filters used for both the Pricing API and the bulk offer files
+PRICING_FILTERS = {
+    "capacityStatus": "Used",
+    "tenancy": "Shared",
+    "licenseModel": "No License required",
+}
+
+
+def add_pricing(imap, pricing_source="api", offers_url=offer_file.OFFERS_URL):
+    """
+    Add on demand and reserved pricing, followed by spot pricing.
+
+    pricing_source selects where the on demand and reserved prices come from:
+    "api" pages the Pricing API, while "bulk" streams the per-region offer files
+    found under offers_url.
+    """
     descriptions = get_region_descriptions()
+    if pricing_source == "bulk":
+        offers = get_bulk_offers(offers_url)
+    else:
+        offers = get_api_offers()
+
+    for offer in offers:
+        add_offer_pricing(imap, descriptions, offer)
+    add_spot_pricing(imap)
+
+
+def get_api_offers():
+    """Page through the EC2 offers of the Pricing API"""
     pricing_client = create_boto3_client("pricing", region_name="us-east-1")
     product_pager = pricing_client.get_paginator("get_products")
 
     product_iterator = product_pager.paginate(
         ServiceCode="AmazonEC2",
         Filters=[
-            {"Type": "TERM_MATCH", "Field": "capacityStatus", "Value": "Used"},
-            {"Type": "TERM_MATCH", "Field": "tenancy", "Value": "Shared"},
-            {
-                "Type": "TERM_MATCH",
-                "Field": "licenseModel",
-                "Value": "No License required",
-            },
+            {"Type": "TERM_MATCH", "Field": field, "Value": value}
+            for field, value in PRICING_FILTERS.items()
         ],
     )
     for product_item in product_iterator:
         for offer_string in product_item.get("PriceList"):
-            offer = json.loads(offer_string)
-            product = offer.get("product")
-            product_attributes = product.get("attributes")
-            instance_type = product_attributes.get("instanceType")
-            location = canonicalize_location(product_attributes.get("location"))
+            yield json.loads(offer_string)
 
-            # Add regions local zones and wavelength zones on the fly as we find them
-            if location not in descriptions:
-                descriptions[location] = product_attributes.get("regionCode")
 
-            region = descriptions[location]
+def get_bulk_offers(offers_url=offer_file.OFFERS_URL):
+    """
+    Stream the EC2 offers of every region from the bulk offer files.
 
-            # Skip Chinese regions because they generate incorrect pricing data
-            if region.startswith("cn-"):
-                continue
+    The offers are assembled in the same shape as the ones returned by the
+    Pricing API, a product along with its OnDemand and Reserved terms.
+    """
+    session = http_cache.create_session()
+    region_files = offer_file.get_region_offer_files(
+        "AmazonEC2", offers_url=offers_url, session=session
+    )
+    for region, url in sorted(region_files.items()):
+        print(f"Streaming EC2 offers for {region} from {url}...")
+        offers = {}
+        with offer_file.open_offer_file(url, session) as fp:
+            for section, sku, value in offer_file.iter_offer_file(fp):
+                if section == "products":
+                    attributes = value.get("attributes", {})
+                    if all(
+                        attributes.get(field) == filter_value
+                        for field, filter_value in PRICING_FILTERS.items()
+                    ):
+                        offers[sku] = {"product": value, "terms": {}}
+                elif sku in offers:
+                    offers[sku]["terms"][section] = value
+        yield from offers.values()
+
+
+def add_offer_pricing(imap, descriptions, offer):
+    product = offer.get("product")
+    product_attributes = product.get("attributes")
+    instance_type = product_attributes.get("instanceType")
+    location = canonicalize_location(product_attributes.get("location"))
+
+    # Add regions local zones and wavelength zones on the fly as we find them
+    if location not in descriptions:
+        descriptions[location] = product_attributes.get("regionCode")
+
+    region = descriptions[location]
+
+    # Skip Chinese regions because they generate incorrect pricing data
+    if region.startswith("cn-"):
+        return
 
-            # Skip capacity block pricing which affects certain p series instances
-            if product_attributes["marketoption"] == "CapacityBlock":
-                continue
+    # Skip capacity block pricing which affects certain p series instances
+    if product_attributes["marketoption"] == "CapacityBlock":
+        return
 
-            terms = offer.get("terms")
+    terms = offer.get("terms")
 
-            operating_system = product_attributes.get("operatingSystem")
-            preinstalled_software = product_attributes.get("preInstalledSw")
-            platform = translate_platform_name(operating_system, preinstalled_software)
+    operating_system = product_attributes.get("operatingSystem")
+    preinstalled_software = product_attributes.get("preInstalledSw")
+    platform = translate_platform_name(operating_system, preinstalled_software)
 
-            if instance_type not in imap:
-                print(
-                    f"WARNING: Ignoring pricing - unknown instance type. instance={instance_type}, location={location}"
-                )
-                continue
+    if instance_type not in imap:
+        print(
+            f"WARNING: Ignoring pricing - unknown instance type. instance={instance_type}, location={location}"
+        )
+        return
 
-            # If the instance type is not in us-east-1 imap[instance_type] could fail
-            try:
-                inst = imap[instance_type]
-                inst.pricing.setdefault(region, {})
-                inst.regions[region] = location
-                inst.pricing[region].setdefault(platform, {})
-                inst.pricing[region][platform]["ondemand"] = get_ondemand_pricing(terms)
-                # Some instances don't offer reserved terms at all
-                reserved = get_reserved_pricing(terms)
-                if reserved:
-                    inst.pricing[region][platform]["reserved"] = reserved
-            except Exception as e:
-                # print more details about the instance for debugging
-                print(f"ERROR: Exception adding pricing for {instance_type}: {e}")
-                print(traceback.print_exc())
-    add_spot_pricing(imap)
+    # If the instance type is not in us-east-1 imap[instance_type] could fail
+    try:
+        inst = imap[instance_type]
+        inst.pricing.setdefault(region, {})
+        inst.regions[region] = location
+        inst.pricing[region].setdefault(platform, {})
+        inst.pricing[region][platform]["ondemand"] = get_ondemand_pricing(terms)
+        # Some instances don't offer reserved terms at all
+        reserved = get_reserved_pricing(terms)
+        if reserved:
+            inst.pricing[region][platform]["reserved"] = reserved
+    except Exception as e:
+        # print more details about the instance for debugging
+        print(f"ERROR: Exception adding pricing for {instance_type}: {e}")
+        print(traceback.print_exc())
 
 
 def format_price(price):
@@ -292,63 +389,69 @@ def get_reserved_pricing(terms):
     return pricing
 
 
-def add_spot_pricing(imap):
-    instance_types = list(imap.keys())
-
-    for region in get_region_descriptions().values():
-        try:
-            # get all spot price data from a region
-            ec2_client = create_boto3_client("ec2", region_name=region)
-            prices_pager = ec2_client.get_paginator("describe_spot_price_history")
-            prices_iterator = prices_pager.paginate(
-                InstanceTypes=instance_types, StartTime=datetime.now()
-            )
-            # populate spot prices into the instance data
-            for p in prices_iterator:
-                prices = p["SpotPriceHistory"]
-                for price in prices:
-                    inst = imap[price["InstanceType"]]
-                    platform = translate_platform_name(
-                        price["ProductDescription"], "NA"
+def get_region_spot_prices(region, instance_types):
+    """
+    Return the raw (instance type, product description, AZ, price) records of a
+    region. When the region fails part way, the records read until then are kept.
+    """
+    records = []
+    try:
+        ec2_client = create_boto3_client("ec2", region_name=region)
+        prices_pager = ec2_client.get_paginator("describe_spot_price_history")
+        prices_iterator = prices_pager.paginate(
+            InstanceTypes=instance_types, StartTime=datetime.now()
+        )
+        for p in prices_iterator:
+            for price in p["SpotPriceHistory"]:
+                records.append(
+                    (
+                        price["InstanceType"],
+                        price["ProductDescription"],
+                        price["AvailabilityZone"],
+                        price["SpotPrice"],
                     )
-                    region = price["AvailabilityZone"][0:-1]
-                    if region in inst.pricing:
-                        inst.pricing[region].setdefault(platform, {})
-                        inst.pricing[region][platform].setdefault("spot", [])
-                        inst.pricing[region][platform].setdefault("spot_min", "N/A")
-                        inst.pricing[region][platform].setdefault("spot_max", "N/A")
-                        inst.pricing[region][platform]["spot"].append(
-                            price["SpotPrice"]
-                        )
-                        inst.pricing[region][platform]["spot"].sort(key=float)
-                        inst.pricing[region][platform]["spot_min"] = inst.pricing[
-                            region
-                        ][platform]["spot"][0]
-                        inst.pricing[region][platform]["spot_max"] = inst.pricing[
-                            region
-                        ][platform]["spot"][-1]
-                    else:
-                        # In rare cases (occuring for the first time in July 2022), instances
-                        # can be available in a region as spots but not on demand or any other
-                        # way. In that case, the logic above will fail and we need to wrap it
-                        # in a conditional and create the region first to put spot prices in
-                        # If more edge cases: print(json.dumps(inst.to_dict(), indent=4))
-                        inst.pricing[region] = {
-                            platform: {
-                                "spot": [price["SpotPrice"]],
-                                "spot_min": price["SpotPrice"],
-                                "spot_max": price["SpotPrice"],
-                            }
-                        }
-
-        except botocore.exceptions.ClientError as e:
-            error_message = e.response.get("Error", {}).get("Message", str(e))
-            print(
-                'WARNING: Spot region "{}" not enabled. Falling back to spot advisor. Error: {}'.format(
-                    region, error_message
                 )
+    except botocore.exceptions.ClientError as e:
+        error_message = e.response.get("Error", {}).get("Message", str(e))
+        print(
+            'WARNING: Spot region "{}" not enabled. Falling back to spot advisor. Error: {}'.format(
+                region, error_message
             )
-            pass
+        )
+    return records
+
+
+def add_spot_pricing(imap, max_workers=16):
+    instance_types = list(imap.keys())
+    regions = list(get_region_descriptions().values())
+
+    # Gather all the per-AZ prices first and only sort them once per (region, platform)
+    spot_prices = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_region = {
+            executor.submit(get_region_spot_prices, region, instance_types): region
+            for region in regions
+        }
+        # Merged in region order, so the regions keep their order between runs
+        for future in future_to_region:
+            for instance_type, product_description, az, spot_price in future.result():
+                platform = translate_platform_name(product_description, "NA")
+                key = (instance_type, az[0:-1], platform)
+                spot_prices.setdefault(key, []).append(spot_price)
+
+    # populate spot prices into the instance data
+    for (instance_type, region, platform), spot in spot_prices.items():
+        inst = imap[instance_type]
+        spot.sort(key=float)
+        # In rare cases (occuring for the first time in July 2022), instances
+        # can be available in a region as spots but not on demand or any other
+        # way. In that case we need to create the region first to put spot prices in
+        # If more edge cases: print(json.dumps(inst.to_dict(), indent=4))
+        inst.pricing.setdefault(region, {})
+        inst.pricing[region].setdefault(platform, {})
+        inst.pricing[region][platform]["spot"] = spot
+        inst.pricing[region][platform]["spot_min"] = spot[0]
+        inst.pricing[region][platform]["spot_max"] = spot[-1]
 
 
 def parse_instance(instance_type, product_attributes, api_description):
@@ -0,0 +1,319 @@
+import hashlib
+import io
+import json
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Responses are kept on disk keyed by URL and revalidated with their ETag or
+# Last-Modified headers, so unchanged pricing files and documentation pages only
+# cost a 304 on the next run. Set HTTP_CACHE_DIR to an empty string to disable.
+CACHE_DIR = os.getenv("HTTP_CACHE_DIR", ".http_cache")
+
+# Largest streamed body, like an offer file, kept in the cache. Those are only
+# cached when this is set, as offer files run into hundreds of MB each.
+STREAM_MAX_BYTES = int(os.getenv("HTTP_CACHE_STREAM_MAX_BYTES", "0"))
+
+_default_session = None
+
+
+def create_session(max_connections=10, max_retries=3):
+    """
+    Create a requests session with a keep-alive connection pool.
+
+    Server errors are retried with backoff, while client errors like a 404 for a
+    pricing file that doesn't exist fail immediately.
+    """
+    retries = Retry(
+        total=max_retries,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(
+        pool_connections=max_connections,
+        pool_maxsize=max_connections,
+        max_retries=retries,
+    )
+    session = requests.Session()
+    # requests transparently decompresses gzip encoded responses
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_default_session():
+    global _default_session
+
+    if _default_session is None:
+        _default_session = create_session()
+    return _default_session
+
+
+def _cache_paths(url):
+    key = hashlib.sha256(url.encode()).hexdigest()
+    path = os.path.join(CACHE_DIR, key)
+    return path + ".body", path + ".json"
+
+
+def _read_cache(url):
+    body_path, meta_path = _cache_paths(url)
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            body = f.read()
+    except (OSError, ValueError):
+        return None, None
+    if meta.get("url") != url:
+        return None, None
+    return meta, body
+
+
+def _write_cache(url, response):
+    validators = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+    if not any(validators.values()):
+        # Nothing to revalidate with, so there's no point in keeping it around
+        return
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    body_path, meta_path = _cache_paths(url)
+    meta = dict(url=url, **validators)
+    # Write to temporary files first so concurrent fetches never see partial data
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(body_path + suffix, "wb") as f:
+        f.write(response.content)
+    with open(meta_path + suffix, "w") as f:
+        json.dump(meta, f)
+    os.replace(body_path + suffix, body_path)
+    os.replace(meta_path + suffix, meta_path)
+
+
+def fetch(url, session=None, timeout=60):
+    """Return the body of url, revalidating a previously cached copy if there is one"""
+    if session is None:
+        session = get_default_session()
+
+    if not CACHE_DIR:
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+
+    meta, body = _read_cache(url)
+    headers = {}
+    if meta:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    response = session.get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304 and body is not None:
+        return body
+    response.raise_for_status()
+
+    _write_cache(url, response)
+    return response.content
+
+
+def open_url(url, session=None):
+    """Like urlopen(url), but going through the cache"""
+    return io.BytesIO(fetch(url, session))
+
+
+def _mirror_meta_path(url):
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, key + ".mirror.json")
+
+
+def _stream_paths(url):
+    key = hashlib.sha256(url.encode()).hexdigest()
+    path = os.path.join(CACHE_DIR, key)
+    return path + ".stream.body", path + ".stream.json"
+
+
+def _local_version(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def mirror(url, file_path, session=None, timeout=60, validate=None):
+    """
+    Stream the body of url to file_path, returns False if it was already current.
+
+    The body is written to a temporary file next to file_path, which replaces it
+    once complete and accepted by validate, called with the temporary path. The
+    local copy is revalidated with its ETag or Last-Modified headers as long as
+    it wasn't changed since it was mirrored.
+    """
+    if session is None:
+        session = get_default_session()
+
+    headers = {}
+    if CACHE_DIR:
+        try:
+            with open(_mirror_meta_path(url), "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        if meta.get("url") == url and meta.get("local") == _local_version(file_path):
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    tmp_path = file_path + suffix
+    with session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code == 304 and headers:
+            return False
+        response.raise_for_status()
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+            if validate is not None:
+                validate(tmp_path)
+            os.replace(tmp_path, file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    if CACHE_DIR:
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "local": _local_version(file_path),
+        }
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        meta_path = _mirror_meta_path(url)
+        with open(meta_path + suffix, "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + suffix, meta_path)
+    return True
+
+
+class CachingStream(object):
+    """
+    File-like reader of a streamed response that copies what is read to the
+    cache as it goes, the body only being kept if it's read without an error and
+    fits in max_bytes.
+    """
+
+    def __init__(self, response, url, max_bytes):
+        self.response = response
+        self.raw = response.raw
+        self.url = url
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.body_path, self.meta_path = _stream_paths(url)
+        self.suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.cache_file = open(self.body_path + self.suffix, "wb")
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        if self.cache_file is not None:
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self.discard()
+            else:
+                self.cache_file.write(data)
+        return data
+
+    def discard(self):
+        if self.cache_file is not None:
+            self.cache_file.close()
+            self.cache_file = None
+            os.remove(self.body_path + self.suffix)
+
+    def commit(self):
+        """Read the rest of the body and keep it in the cache"""
+        while self.cache_file is not None and self.read(1 << 20):
+            pass
+        if self.cache_file is None:
+            return
+        self.cache_file.close()
+        self.cache_file = None
+        meta = {
+            "url": self.url,
+            "etag": self.response.headers.get("ETag"),
+            "last_modified": self.response.headers.get("Last-Modified"),
+        }
+        os.replace(self.body_path + self.suffix, self.body_path)
+        meta["local"] = _local_version(self.body_path)
+        with open(self.meta_path + self.suffix, "w") as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path + self.suffix, self.meta_path)
+
+    def close(self):
+        self.discard()
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            self.close()
+
+
+def open_stream(url, session=None, timeout=60):
+    """
+    Open the body of url as a binary file, for bodies too large for fetch.
+
+    The body is read from the network while it downloads. With
+    HTTP_CACHE_STREAM_MAX_BYTES set, bodies up to that size are also copied to
+    the cache as they are read in a with block, and revalidated on the next run
+    so that an unchanged body is read from disk after a 304.
+    """
+    if session is None:
+        session = get_default_session()
+
+    cached = CACHE_DIR and STREAM_MAX_BYTES > 0
+    headers = {}
+    if cached:
+        body_path, meta_path = _stream_paths(url)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        local = _local_version(body_path)
+        if local is not None and meta.get("url") == url and meta.get("local") == local:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+    response = session.get(url, headers=headers, stream=True, timeout=timeout)
+    if response.status_code == 304 and headers:
+        response.close()
+        return open(body_path, "rb")
+    response.raise_for_status()
+    # Let urllib3 undo any Content-Encoding while we read
+    response.raw.decode_content = True
+
+    # Only bodies that can be revalidated and may fit are copied to the cache. A
+    # compressed body longer than the limit won't fit once decoded either.
+    length = response.headers.get("Content-Length", "")
+    if (
+        not cached
+        or not (response.headers.get("ETag") or response.headers.get("Last-Modified"))
+        or (length.isdigit() and int(length) > STREAM_MAX_BYTES)
+    ):
+        return response.raw
+    return CachingStream(response, url, STREAM_MAX_BYTES)
@@ -137,25 +137,8 @@
     <!-- Custom JS -->
     <script type="text/javascript">
         % if pricing_json:
+          // decoded by get_pricing in default.js
           var _pricing = ${pricing_json};
-          function get_pricing() {
-              // see compress_pricing in render.py for the generation side
-              v = _pricing["data"];
-              for (var i = 0; i < arguments.length; i++) {
-                  if (arguments[i] === "none") {
-                    // this is for services like Redshift and OpenSearch which 
-                    // do not have multiple 'platforms'. RDS for example has 20 
-                    // OS's, and ElastiCache has Memcached and Redis
-                    continue;
-                  }
-                  k = _pricing["index"][arguments[i]];
-                  v = v[k];
-                  if (v === undefined) {
-                      return undefined;
-                  }
-              }
-              return v;
-          }
           var _instance_azs = ${instance_azs_json};
           function get_instance_availability_zones(instance_type, region) {
             var region_azs = _instance_azs[instance_type];
@@ -160,7 +160,7 @@
     </div>
 
   <div class="table-responsive overflow-auto wrap-table flex-fill">
-    <table cellspacing="0" style="border-bottom: 0 !important; margin-bottom: 0 !important;" id="data" width="100%" class="table">
+    <table cellspacing="0" style="border-bottom: 0 !important; margin-bottom: 0 !important;" id="data" width="100%" class="table" data-rows="${rows_url or ''}">
       <thead>
         <tr>
           <th class="name all" data-priority="1"><div class="d-none d-md-block">Name</div></th>
@@ -288,7 +288,16 @@
       </thead>
 
       <tbody>
-        % for inst in instances:
+        ## with initial_rows only the first rows are inlined and default.js
+        ## loads the rest from rows_url, see instance_rows below
+        % for inst in (instances[:initial_rows] if initial_rows else instances):
+          ${instance_row(inst)}
+        % endfor
+      </tbody>
+    </table>
+  </div>
+
+<%def name="instance_row(inst)">
           <tr class='instance' id="${inst['instance_type']}">
             <td class="name all"><div class="d-none d-md-block">${inst['pretty_name']}</div></td>
             <td class="apiname"><a href="/aws/ec2/${inst['instance_type']}">${inst['instance_type']}</a></td>
@@ -587,7 +596,10 @@
             </td>
             <td class="generation hidden">${inst['generation']}</td>
           </tr>
-        % endfor
-      </tbody>
-    </table>
-  </div>
+</%def>
+
+<%def name="instance_rows(instances)">
+  % for inst in instances:
+    ${instance_row(inst)}
+  % endfor
+</%def>
@@ -0,0 +1,179 @@
+import codecs
+import json
+import os
+
+import http_cache
+
+# The AWS bulk pricing offer files, see
+# https://docs.aws.amazon.com/awsaccountbilling/latest/aboutv2/using-ppslong.html
+# Point OFFERS_URL to a local web server to run against fixture files instead.
+OFFERS_URL = os.getenv("OFFERS_URL", "https://pricing.us-east-1.amazonaws.com")
+
+_whitespace = " \t\n\r"
+_decoder = json.JSONDecoder()
+
+
+class StreamReader(object):
+    """
+    Incremental reader for a JSON document too large to load at once.
+
+    Objects can be walked key by key with iter_object() while the values we are
+    interested in, like a single product or the terms of a SKU, are decoded with
+    read_value(). Only a small window of the document is kept in memory.
+    """
+
+    def __init__(self, fp, chunk_size=1 << 20):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = ""
+        while not chunk:
+            if self.eof:
+                return False
+            data = self.fp.read(self.chunk_size)
+            self.eof = not data
+            if isinstance(data, bytes):
+                # May be empty when a multi-byte character is split across reads
+                data = self.decoder.decode(data, final=self.eof)
+            chunk = data
+        # Drop what has already been consumed
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return
+
+    def _next_char(self):
+        self._skip_whitespace()
+        if self.pos >= len(self.buffer):
+            raise ValueError("Unexpected end of JSON document")
+        c = self.buffer[self.pos]
+        self.pos += 1
+        return c
+
+    def _expect(self, expected):
+        c = self._next_char()
+        if c != expected:
+            raise ValueError(
+                "Expected {!r} but found {!r} at offset {}".format(
+                    expected, c, self.pos
+                )
+            )
+
+    def read_value(self):
+        """Decode the next JSON value"""
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # The value may just be cut off at the end of the buffer
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def iter_object(self):
+        """
+        Yield the keys of the next JSON object.
+
+        The caller must consume the value of each key, with read_value() or a
+        nested iter_object(), before asking for the next key.
+        """
+        self._expect("{")
+        self._skip_whitespace()
+        if self.buffer[self.pos : self.pos + 1] == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self._expect(":")
+            yield key
+            c = self._next_char()
+            if c == "}":
+                return
+            if c != ",":
+                raise ValueError(
+                    "Expected ',' or '}}' but found {!r} at offset {}".format(
+                        c, self.pos
+                    )
+                )
+
+
+def iter_offer_file(fp):
+    """
+    Stream the entries of an offer file.
+
+    Yields ("products", sku, product) for every product, followed by
+    (term_type, sku, offers) for the terms of every SKU, where term_type is
+    "OnDemand" or "Reserved".
+    """
+    reader = StreamReader(fp)
+    for key in reader.iter_object():
+        if key == "products":
+            for sku in reader.iter_object():
+                yield "products", sku, reader.read_value()
+        elif key == "terms":
+            for term_type in reader.iter_object():
+                for sku in reader.iter_object():
+                    yield term_type, sku, reader.read_value()
+        else:
+            # formatVersion, publicationDate, etc.
+            reader.read_value()
+
+
+def open_offer_file(location, session=None):
+    """
+    Open an offer file given either as a URL or as a local path. URLs go through
+    the HTTP cache, see http_cache.open_stream.
+    """
+    if location.startswith("http://") or location.startswith("https://"):
+        return http_cache.open_stream(location, session)
+    return open(location, "rb")
+
+
+def get_region_offer_files(service_code, offers_url=OFFERS_URL, session=None):
+    """Return the URL of the current offer file of each region of a service"""
+    index_url = "{}/offers/v1.0/aws/{}/current/region_index.json".format(
+        offers_url, service_code
+    )
+    region_index = json.loads(http_cache.fetch(index_url, session))
+    return {
+        region: offers_url + details["currentVersionUrl"]
+        for region, details in region_index["regions"].items()
+    }
+
+
+def load_offer_file(location, product_filter, session=None):
+    """
+    Stream an offer file, keeping only the products accepted by product_filter.
+
+    Returns a dict shaped like the offer file itself, {"products": ...,
+    "terms": {"OnDemand": ..., "Reserved": ...}}, but holding only the selected
+    products and their terms. Offer files list all products before the terms, so
+    the terms can be filtered as they stream by.
+    """
+    products = {}
+    terms = {"OnDemand": {}, "Reserved": {}}
+    with open_offer_file(location, session) as fp:
+        for section, sku, value in iter_offer_file(fp):
+            if section == "products":
+                if product_filter(value):
+                    products[sku] = value
+            elif sku in products:
+                terms.setdefault(section, {})[sku] = value
+    return {"products": products, "terms": terms}
@@ -0,0 +1,303 @@
+import re
+
+import ec2
+import offer_file
+
+# Price dimensions that aren't for running an instance
+DEFAULT_SKIPPED_DIMENSIONS = ["transfer", "global", "iops", "requests", "multi-az"]
+
+# Translate between the offer file reserved terms and what is used locally. The
+# Light, Medium and Heavy utilization terms are from previous generations and are
+# not available for choosing anymore in AWS console, so they are read but dropped
+# when calculating the effective prices.
+RESERVED_MAPPING = {
+    "1yr All Upfront": "yrTerm1.allUpfront",
+    "1yr Partial Upfront": "yrTerm1.partialUpfront",
+    "1yr No Upfront": "yrTerm1.noUpfront",
+    "1yr Light Utilization": "yrTerm1.lightUtilization",
+    "1yr Medium Utilization": "yrTerm1.mediumUtilization",
+    "1yr Heavy Utilization": "yrTerm1.heavyUtilization",
+    "3yr All Upfront": "yrTerm3.allUpfront",
+    "3yr Partial Upfront": "yrTerm3.partialUpfront",
+    "3yr No Upfront": "yrTerm3.noUpfront",
+    "3yr Light Utilization": "yrTerm3.lightUtilization",
+    "3yr Medium Utilization": "yrTerm3.mediumUtilization",
+    "3yr Heavy Utilization": "yrTerm3.heavyUtilization",
+}
+
+
+class OfferService(object):
+    """
+    How to turn the offer file of a service into instances.
+
+    Parameters:
+    - name: Service name used in messages (e.g. 'RDS')
+    - offer_code: Offer code of the service in the bulk pricing files
+    - product_family: productFamily of the instance products
+    - memory_attribute: Product attribute holding the memory (default: 'memory')
+    - family_attribute: Product attribute holding the family (default: 'instanceFamily')
+    - network_performance: Whether to copy networkPerformance to network_performance
+    - engine: (local name, product attribute) of the engine the prices are
+      grouped by, or None when prices are kept directly under the region
+    - optional_attributes: Local names of product attributes copied when present
+    - inconsistent_attributes: Attributes that differ among the SKUs of an
+      instance type and are dropped from the instance
+    - skipped_dimensions: Price dimension descriptions which aren't instance prices
+    - accept_product: Called with a product to select the instance products
+      beyond their productFamily
+    - accept_sku: Called with the sku and its attributes once the region is known,
+      returns False to ignore the SKU
+    - ondemand_keys, reserved_keys: Called with the SKU attributes, return the
+      keys its on demand and reserved prices are stored under within a region
+    """
+
+    def __init__(
+        self,
+        name,
+        offer_code,
+        product_family,
+        memory_attribute="memory",
+        family_attribute="instanceFamily",
+        network_performance=False,
+        engine=None,
+        optional_attributes=None,
+        inconsistent_attributes=(),
+        skipped_dimensions=DEFAULT_SKIPPED_DIMENSIONS,
+        accept_product=None,
+        accept_sku=None,
+        ondemand_keys=None,
+        reserved_keys=None,
+    ):
+        self.name = name
+        self.offer_code = offer_code
+        self.product_family = product_family
+        self.memory_attribute = memory_attribute
+        self.family_attribute = family_attribute
+        self.network_performance = network_performance
+        self.engine = engine
+        self.optional_attributes = optional_attributes or {}
+        self.inconsistent_attributes = [
+            "location",
+            "locationType",
+            "operation",
+            "region",
+            "usagetype",
+        ] + list(inconsistent_attributes)
+        self.skipped_dimensions = re.compile(
+            "|".join(re.escape(d) for d in skipped_dimensions)
+        )
+        self.accept_product = accept_product or (lambda product: True)
+        self.accept_sku = accept_sku or (lambda sku, attributes: True)
+        self.ondemand_keys = ondemand_keys or self.engine_keys
+        self.reserved_keys = reserved_keys or self.engine_keys
+
+    def engine_keys(self, attributes):
+        if self.engine is None:
+            return []
+        return [attributes[self.engine[0]]]
+
+    def is_instance_product(self, product):
+        return product.get(
+            "productFamily", None
+        ) == self.product_family and self.accept_product(product)
+
+    def offer_file_url(self):
+        return "{}/offers/v1.0/aws/{}/current/index.json".format(
+            offer_file.OFFERS_URL, self.offer_code
+        )
+
+
+def calculate_reserved_prices(reserved):
+    """Calculate the effective hourly reserved prices (upfront hourly + hourly price)"""
+    reserved_prices = {}
+
+    if "yrTerm3.partialUpfront-quantity" in reserved:
+        reserved_prices["yrTerm3Standard.partialUpfront"] = (
+            reserved["yrTerm3.partialUpfront-quantity"] / (365 * 3) / 24
+        ) + reserved["yrTerm3.partialUpfront-hrs"]
+
+    if "yrTerm1.partialUpfront-quantity" in reserved:
+        reserved_prices["yrTerm1Standard.partialUpfront"] = (
+            reserved["yrTerm1.partialUpfront-quantity"] / 365 / 24
+        ) + reserved["yrTerm1.partialUpfront-hrs"]
+
+    if "yrTerm3.allUpfront-quantity" in reserved:
+        reserved_prices["yrTerm3Standard.allUpfront"] = (
+            reserved["yrTerm3.allUpfront-quantity"] / (365 * 3) / 24
+        ) + reserved["yrTerm3.allUpfront-hrs"]
+
+    if "yrTerm1.allUpfront-quantity" in reserved:
+        reserved_prices["yrTerm1Standard.allUpfront"] = (
+            reserved["yrTerm1.allUpfront-quantity"] / 365 / 24
+        ) + reserved["yrTerm1.allUpfront-hrs"]
+
+    if "yrTerm1.noUpfront-hrs" in reserved:
+        reserved_prices["yrTerm1Standard.noUpfront"] = reserved[
+            "yrTerm1.noUpfront-hrs"
+        ]
+
+    if "yrTerm3.noUpfront-hrs" in reserved:
+        reserved_prices["yrTerm3Standard.noUpfront"] = reserved[
+            "yrTerm3.noUpfront-hrs"
+        ]
+
+    return reserved_prices
+
+
+def ingest(service, input_file=None):
+    """
+    Build the instances of a service from its offer file, keyed by instance type.
+
+    The offer file is streamed from the AWS bulk pricing files unless a local
+    input_file is given.
+    """
+    data = offer_file.load_offer_file(
+        input_file or service.offer_file_url(), service.is_instance_product
+    )
+
+    sku_instances = {}
+    instances = {}
+
+    # region mapping, someone thought it was handy not to include the region id's :(
+    regions = ec2.get_region_descriptions()
+
+    # loop through products, and only fetch available instances for now
+    for sku, product in data["products"].items():
+        attributes = product["attributes"]
+        instance_type = attributes["instanceType"]
+
+        # map the region
+        location = ec2.canonicalize_location(attributes["location"])
+        if location == "Any":
+            region = "us-east-1"
+        elif location == "Asia Pacific (Osaka-Local)":
+            # at one point this region was local but was upgraded to a standard region
+            # however some SKUs still reference the old region
+            region = "ap-northeast-3"
+            regions[location] = region
+        elif location in regions:
+            region = regions[location]
+        else:
+            region = attributes["regionCode"]
+            regions[location] = region
+
+        # set the attributes in line with the ec2 index
+        attributes["region"] = region
+        attributes["memory"] = attributes[service.memory_attribute].split(" ")[0]
+        if service.network_performance:
+            attributes["network_performance"] = attributes.get(
+                "networkPerformance", None
+            )
+        attributes["family"] = attributes[service.family_attribute]
+        attributes["instance_type"] = instance_type
+        if service.engine:
+            attributes[service.engine[0]] = attributes[service.engine[1]]
+        for name, attribute in service.optional_attributes.items():
+            attributes[name] = attributes.get(attribute, None)
+        attributes["pricing"] = {}
+        attributes["pricing"][region] = {}
+
+        if not service.accept_sku(sku, attributes):
+            continue
+
+        sku_instances[sku] = attributes
+
+        if instance_type not in instances:
+            # delete some attributes that are inconsistent among skus
+            new_attributes = (
+                attributes.copy()
+            )  # make copy so we can keep these attributes with the sku
+            for attribute in service.inconsistent_attributes:
+                new_attributes.pop(attribute, None)
+            new_attributes["pricing"] = attributes["pricing"]
+            new_attributes["regions"] = {}
+
+            instances[instance_type] = new_attributes
+
+    # The first location listed for each region is used as the region name
+    region_names = {}
+    for l, r in regions.items():
+        region_names.setdefault(r, l)
+
+    # Parse ondemand pricing
+    for sku, offers in data["terms"]["OnDemand"].items():
+        instance = sku_instances.get(sku)
+        if not instance:
+            continue
+
+        region = instance["region"]
+        instance_pricing = instances[instance["instance_type"]]["pricing"]
+        keys = service.ondemand_keys(instance)
+
+        for code, offer in offers.items():
+            for key, dimension in offer["priceDimensions"].items():
+                # skip these for now
+                if service.skipped_dimensions.search(dimension["description"].lower()):
+                    continue
+
+                price = {"ondemand": float(dimension["pricePerUnit"]["USD"])}
+                if keys:
+                    region_pricing = instance_pricing.setdefault(region, {})
+                    for k in keys:
+                        region_pricing[k] = dict(price)
+                else:
+                    instance_pricing[region] = price
+
+                # build the list of regions where each instance is available
+                instances[instance["instance_type"]]["regions"][region] = (
+                    region_names.get(region, "")
+                )
+
+    # Parse reserved pricing
+    for sku, offers in data["terms"]["Reserved"].items():
+        instance = sku_instances.get(sku)
+        if not instance:
+            continue
+
+        region = instance["region"]
+        instance_pricing = instances[instance["instance_type"]]["pricing"]
+        keys = service.reserved_keys(instance)
+
+        for code, offer in offers.items():
+            reserved_type = "%s %s" % (
+                offer["termAttributes"]["LeaseContractLength"],
+                offer["termAttributes"]["PurchaseOption"],
+            )
+            for key, dimension in offer["priceDimensions"].items():
+                # create the regional, engine and reserved hashes
+                region_pricing = instance_pricing.setdefault(region, {})
+                if keys:
+                    reserved_hashes = [
+                        region_pricing.setdefault(k, {}).setdefault("reserved", {})
+                        for k in keys
+                    ]
+                else:
+                    reserved_hashes = [region_pricing.setdefault("reserved", {})]
+
+                for reserved in reserved_hashes:
+                    reserved[
+                        "%s-%s"
+                        % (RESERVED_MAPPING[reserved_type], dimension["unit"].lower())
+                    ] = float(dimension["pricePerUnit"]["USD"])
+
+    # Calculate all reserved effective pricings (upfront hourly + hourly price)
+    for instance_type, instance in instances.items():
+        for region, pricing in instance["pricing"].items():
+            if service.engine is None:
+                prices = [pricing]
+            else:
+                prices = pricing.values()
+            for p in prices:
+                if "reserved" not in p:
+                    continue
+                try:
+                    # no multi-az here
+                    p["reserved"] = calculate_reserved_prices(p["reserved"])
+                except Exception as e:
+                    print(
+                        "ERROR: Trouble generating {} reserved price for {}: {!r}".format(
+                            service.name, instance_type, e
+                        )
+                    )
+
+    return instances
@@ -0,0 +1,91 @@
+import concurrent.futures
+import gzip
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Text files worth serving compressed
+COMPRESSIBLE_EXTENSIONS = (".html", ".json", ".js", ".css", ".xml", ".svg", ".txt")
+
+# File suffix of each precompressed variant and its Content-Encoding
+ENCODINGS = {".gz": "gzip", ".br": "br"}
+
+
+def compress_gzip(data):
+    # mtime=0 keeps the output identical for identical input
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def compress_brotli(data):
+    return brotli.compress(data, quality=11)
+
+
+def get_compressors():
+    """Return the compressor of each variant that can be built here"""
+    compressors = {".gz": compress_gzip}
+    if brotli is not None:
+        compressors[".br"] = compress_brotli
+    return compressors
+
+
+def compress_file(path, compressors=None):
+    """
+    Write the precompressed variants of a file next to it, e.g. index.html.gz.
+    Variants that are newer than the file are kept. Returns the number written.
+    """
+    if compressors is None:
+        compressors = get_compressors()
+
+    current = get_variants(path)
+    data = None
+    written = 0
+    for suffix, compress in compressors.items():
+        if suffix in current:
+            continue
+        variant = path + suffix
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        tmp_path = "{}.{}.{}".format(variant, os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(compress(data))
+        os.replace(tmp_path, variant)
+        written += 1
+    return written
+
+
+def get_variants(path):
+    """Return the suffix and path of each precompressed variant that is up to date"""
+    source_mtime = os.stat(path).st_mtime
+    variants = {}
+    for suffix in ENCODINGS:
+        variant = path + suffix
+        if os.path.exists(variant) and os.stat(variant).st_mtime >= source_mtime:
+            variants[suffix] = variant
+    return variants
+
+
+def compress_tree(root_dir="www", max_workers=8):
+    """Precompress every compressible file below root_dir"""
+    compressors = get_compressors()
+    if brotli is None:
+        print("WARNING: brotli is not installed, only writing gzip variants")
+
+    paths = []
+    for root, dirs, files in os.walk(root_dir):
+        for name in files:
+            if name.startswith(".") or not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            paths.append(os.path.join(root, name))
+
+    print("Precompressing %d files in %s..." % (len(paths), root_dir))
+    # zlib and brotli release the GIL while compressing
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        written = sum(
+            executor.map(lambda path: compress_file(path, compressors), paths)
+        )
+    print("Wrote %d precompressed files" % written)
@@ -0,0 +1,249 @@
+import collections
+import email.utils
+import gzip
+import hashlib
+import http.server
+import mimetypes
+import os
+import posixpath
+import threading
+import urllib.parse
+
+from precompress import COMPRESSIBLE_EXTENSIONS, get_variants
+
+# Bytes of file contents the preview server keeps in memory
+PREVIEW_CACHE_BYTES = int(os.getenv("PREVIEW_CACHE_BYTES", str(256 * 1024 * 1024)))
+
+# Content encodings served by the preview server, in order of preference, and the
+# suffix of their precompressed variant
+PREVIEW_ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+
+class FileCache(object):
+    """
+    Least recently used cache of the representations of files, a representation
+    being a file's body in one content encoding and its ETag.
+
+    An entry is only used while the file it was read from keeps its mtime and
+    size. Bodies larger than an eighth of max_bytes aren't kept.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, stat):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != (stat.st_mtime_ns, stat.st_size):
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, stat, representation):
+        body = representation[0]
+        if len(body) > self.max_bytes // 8:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1][0])
+            self.entries[key] = ((stat.st_mtime_ns, stat.st_size), representation)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (_, (evicted, _)) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+def byte_range(header, length):
+    """
+    Return the first and last byte of a Range header for a body of length bytes.
+    None is returned for anything but a single byte range, which is then ignored,
+    and ValueError raised if the range can't be satisfied.
+    """
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    start, sep, end = ranges.strip().partition("-")
+    if not sep or not (start.isdigit() or end.isdigit()):
+        return None
+    if start and end and int(end) < int(start):
+        return None
+
+    if not start:
+        # the last bytes of the body
+        if int(end) == 0 or length == 0:
+            raise ValueError("Unsatisfiable range")
+        return max(length - int(end), 0), length - 1
+    if int(start) >= length:
+        raise ValueError("Unsatisfiable range")
+    if not end:
+        return int(start), length - 1
+    return int(start), min(int(end), length - 1)
+
+
+class PreviewHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the generated site in the current directory from memory.
+
+    Compressible files are sent in the best content encoding the client accepts,
+    from their precompressed variant or else gzipped once and kept. Every
+    representation has an ETag for conditional requests, and single byte ranges
+    are served from the uncompressed file.
+    """
+
+    server_version = "PreviewHTTP/1.0"
+    protocol_version = "HTTP/1.1"
+    cache = FileCache(PREVIEW_CACHE_BYTES)
+
+    def do_GET(self):
+        self.send_file(head=False)
+
+    def do_HEAD(self):
+        self.send_file(head=True)
+
+    def log_message(self, format, *args):
+        # Every request would be logged otherwise, which slows down load tests
+        pass
+
+    def translate_path(self, path):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+        # The URL does not include ".html". Add it to serve the file for dev
+        if "/aws/" in path:
+            path += ".html"
+        parts = [p for p in posixpath.normpath(path).split("/") if p not in ("", "..")]
+        return os.path.join(os.getcwd(), *parts)
+
+    def accepted_encodings(self):
+        accepted = set()
+        for coding in self.headers.get("Accept-Encoding", "").split(","):
+            name, _, params = coding.partition(";")
+            try:
+                if params and float(params.split("=")[1]) == 0:
+                    continue
+            except (IndexError, ValueError):
+                continue
+            accepted.add(name.strip().lower())
+        return accepted
+
+    def get_representation(self, path, encoding):
+        """Return the body and ETag of a file in a content encoding"""
+        source = path
+        if encoding is not None:
+            suffix = dict(PREVIEW_ENCODINGS)[encoding]
+            source = get_variants(path).get(suffix, path)
+        stat = os.stat(source)
+
+        representation = self.cache.get((path, encoding), stat)
+        if representation is None:
+            with open(source, "rb") as f:
+                body = f.read()
+            if source == path and encoding == "gzip":
+                body = gzip.compress(body, compresslevel=6, mtime=0)
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            representation = (body, etag)
+            self.cache.put((path, encoding), stat, representation)
+        return representation
+
+    def send_file(self, head):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            url = urllib.parse.urlsplit(self.path)
+            if not url.path.endswith("/"):
+                # Relative links of directory index pages need the trailing slash
+                self.send_response(301)
+                self.send_header(
+                    "Location",
+                    urllib.parse.urlunsplit(url._replace(path=url.path + "/")),
+                )
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            path = os.path.join(path, "index.html")
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return
+
+        compressible = path.endswith(COMPRESSIBLE_EXTENSIONS)
+        encoding = None
+        if compressible and "Range" not in self.headers:
+            accepted = self.accepted_encodings()
+            encoding = next((e for e, _ in PREVIEW_ENCODINGS if e in accepted), None)
+            if encoding == "br" and ".br" not in get_variants(path):
+                # Only gzip is compressed on the fly
+                encoding = "gzip" if "gzip" in accepted else None
+
+        try:
+            body, etag = self.get_representation(path, encoding)
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None and (
+            if_none_match.strip() == "*"
+            or etag in [t.strip().replace("W/", "") for t in if_none_match.split(",")]
+        ):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            if compressible:
+                self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+
+        status = 200
+        content_range = None
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range", etag) == etag:
+            try:
+                selected = byte_range(range_header, len(body))
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(len(body)))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if selected is not None:
+                status = 206
+                content_range = "bytes {}-{}/{}".format(
+                    selected[0], selected[1], len(body)
+                )
+                body = body[selected[0] : selected[1] + 1]
+
+        if path.endswith(".html"):
+            content_type = "text/html"
+        else:
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header(
+            "Last-Modified",
+            email.utils.formatdate(os.stat(path).st_mtime, usegmt=True),
+        )
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Cache-Control", "no-cache")
+        if compressible:
+            self.send_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        if content_range is not None:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+
+        if not head:
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+
+class PreviewServer(http.server.ThreadingHTTPServer):
+    """HTTP server handling each connection in its own thread"""
+
+    allow_reuse_address = True
+    request_queue_size = 128
@@ -1,11 +1,10 @@
 #!/usr/bin/env python
-import requests
 import json
 from json import encoder
 import sys
-import six
 import os
 import ec2
+import offer_ingest
 import locale
 import re
 from lxml import etree
@@ -82,297 +81,96 @@ def totext(elt):
     return re.sub(r"\*\d$", "", s)
 
 
-def add_ebs_info(instances):
+def load_ec2_instances(ec2_data_file=None):
+    """
+    Return the EC2 instance specs as dicts, preferring an already built
+    instances.json and otherwise the instances scraped earlier in this process.
+    """
+    if ec2_data_file and os.path.exists(ec2_data_file):
+        print(f"Loading EC2 instance specs from {ec2_data_file}...")
+        with open(ec2_data_file) as f:
+            return json.load(f)
+    return [i.to_dict() for i in ec2.get_cached_instances()]
+
+
+def add_ebs_info(instances, ec2_data_file=None):
     by_type = {k: v for k, v in instances.items()}
 
-    ec2_instances = ec2.get_instances()
+    ec2_instances = load_ec2_instances(ec2_data_file)
 
     for i in ec2_instances:
-        instance_type = "db." + i.instance_type
+        instance_type = "db." + i["instance_type"]
 
         if instance_type in by_type:
-            by_type[instance_type]["ebs_optimized"] = i.ebs_optimized
-            by_type[instance_type][
-                "ebs_baseline_throughput"
-            ] = i.ebs_baseline_throughput
-            by_type[instance_type]["ebs_baseline_iops"] = i.ebs_baseline_iops
-            by_type[instance_type]["ebs_baseline_bandwidth"] = i.ebs_baseline_bandwidth
-            by_type[instance_type]["ebs_throughput"] = i.ebs_throughput
-            by_type[instance_type]["ebs_iops"] = i.ebs_iops
-            by_type[instance_type]["ebs_max_bandwidth"] = i.ebs_max_bandwidth
-
-
-def scrape(output_file, input_file=None):
-    # if an argument is given, use that as the path for the json file
-    if input_file:
-        with open(input_file) as json_data:
-            data = json.load(json_data)
+            for key in [
+                "ebs_optimized",
+                "ebs_baseline_throughput",
+                "ebs_baseline_iops",
+                "ebs_baseline_bandwidth",
+                "ebs_throughput",
+                "ebs_iops",
+                "ebs_max_bandwidth",
+            ]:
+                by_type[instance_type][key] = i[key]
+
+
+def accept_sku(sku, attributes):
+    if attributes.get("engineCode", None) == None:
+        print(
+            f"WARNING: No Engine Code found. Ignoring instance with sku={sku}, instance={attributes['instance_type']}"
+        )
+        return False
+    return attributes["engineCode"] not in ["210", "220"]
+
+
+def ondemand_keys(attributes):
+    if attributes["storage"] == "Aurora IO Optimization Mode":
+        engine_code = "211"
     else:
-        price_index = "https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonRDS/current/index.json"
-        index = requests.get(price_index)
-        data = index.json()
-
-    rds_instances = {}
-    instances = {}
-
-    # region mapping, someone thought it was handy not to include the region id's :(
-    regions = ec2.get_region_descriptions()
-
-    # loop through products, and only fetch available instances for now
-    for sku, product in six.iteritems(data["products"]):
-        if product.get("productFamily", None) == "Database Instance":
-            attributes = product["attributes"]
-
-            # skip multi-az
-            if attributes["deploymentOption"] != "Single-AZ":
-                continue
-
-            # map the region
-            location = ec2.canonicalize_location(attributes["location"])
-            instance_type = attributes["instanceType"]
-
-            if location == "Any":
-                region = "us-east-1"
-            elif location == "Asia Pacific (Osaka-Local)":
-                # at one point this region was local but was upgraded to a standard region
-                # however some SKUs still reference the old region
-                region = "ap-northeast-3"
-                regions[location] = region
-            elif location not in regions.values():
-                region = attributes["regionCode"]
-                regions[location] = region
-            else:
-                region = regions[location]
-
-            # set the attributes in line with the ec2 index
-            attributes["region"] = region
-            attributes["memory"] = attributes["memory"].split(" ")[0]
-            attributes["network_performance"] = attributes.get(
-                "networkPerformance", None
-            )
-            attributes["family"] = attributes["instanceFamily"]
-            attributes["instance_type"] = instance_type
-            attributes["database_engine"] = attributes["databaseEngine"]
-            attributes["arch"] = attributes.get("processorArchitecture", None)
-            attributes["pricing"] = {}
-            attributes["pricing"][region] = {}
-
-            if attributes.get("engineCode", None) == None:
-                print(
-                    f"WARNING: No Engine Code found. Ignoring instance with sku={sku}, instance={instance_type}"
-                )
-                continue
-
-            if attributes["engineCode"] not in ["210", "220"]:
-                rds_instances[sku] = attributes
-
-                if instance_type not in instances.keys():
-                    # delete some attributes that are inconsistent among skus
-                    new_attributes = (
-                        attributes.copy()
-                    )  # make copy so we can keep these attributes with the sku
-                    new_attributes.pop("databaseEdition", None)
-                    new_attributes.pop("databaseEngine", None)
-                    new_attributes.pop("database_engine", None)
-                    new_attributes.pop("deploymentOption", None)
-                    new_attributes.pop("engineCode", None)
-                    new_attributes.pop("licenseModel", None)
-                    new_attributes.pop("location", None)
-                    new_attributes.pop("locationType", None)
-                    new_attributes.pop("operation", None)
-                    new_attributes.pop("region", None)
-                    new_attributes.pop("usagetype", None)
-                    new_attributes["pricing"] = attributes["pricing"]
-                    new_attributes["regions"] = {}
-
-                    instances[instance_type] = new_attributes
-
-    # Parse ondemand pricing
-    for sku, offers in six.iteritems(data["terms"]["OnDemand"]):
-        for code, offer in six.iteritems(offers):
-            for key, dimension in six.iteritems(offer["priceDimensions"]):
-                # skip these for now
-                if any(
-                    descr in dimension["description"].lower()
-                    for descr in [
-                        "transfer",
-                        "global",
-                        "storage",
-                        "iops",
-                        "requests",
-                        "multi-az",
-                    ]
-                ):
-                    continue
-
-                instance = rds_instances.get(sku)
-                if not instance:
-                    # print(f"WARNING: Received on demand pricing info for unknown sku={sku}")
-                    continue
-
-                if (
-                    instance["region"]
-                    not in instances[instance["instance_type"]]["pricing"]
-                ):
-                    instances[instance["instance_type"]]["pricing"][
-                        instance["region"]
-                    ] = {}
-
-                if instance["storage"] == "Aurora IO Optimization Mode":
-                    instances[instance["instance_type"]]["pricing"][instance["region"]][
-                        "211"
-                    ] = {"ondemand": float(dimension["pricePerUnit"]["USD"])}
-                else:
-                    instances[instance["instance_type"]]["pricing"][instance["region"]][
-                        instance["engineCode"]
-                    ] = {"ondemand": float(dimension["pricePerUnit"]["USD"])}
-
-                # keep this for backwards compatibility, even though it's wrong
-                # (database_engine is not unique, so multiple offerings overlap)
-                instances[instance["instance_type"]]["pricing"][instance["region"]][
-                    instance["database_engine"]
-                ] = {"ondemand": float(dimension["pricePerUnit"]["USD"])}
-
-                # build the list of regions where each instance is available
-                # we have to do a reverse lookup from the regions list
-                l = ""
-                for l, r in regions.items():
-                    if instance["region"] == r:
-                        location = l
-                        break
-                instances[instance["instance_type"]]["regions"][instance["region"]] = l
-
-    reserved_mapping = {
-        "3yr Partial Upfront": "yrTerm3.partialUpfront",
-        "1yr Partial Upfront": "yrTerm1.partialUpfront",
-        "3yr All Upfront": "yrTerm3.allUpfront",
-        "1yr All Upfront": "yrTerm1.allUpfront",
-        "1yr No Upfront": "yrTerm1.noUpfront",
-        "3yr No Upfront": "yrTerm3.noUpfront",
-    }
+        engine_code = attributes["engineCode"]
+    # keep database_engine for backwards compatibility, even though it's wrong
+    # (database_engine is not unique, so multiple offerings overlap)
+    return [engine_code, attributes["database_engine"]]
+
+
+RDS_OFFERS = offer_ingest.OfferService(
+    "RDS",
+    "AmazonRDS",
+    "Database Instance",
+    network_performance=True,
+    engine=("database_engine", "databaseEngine"),
+    optional_attributes={"arch": "processorArchitecture"},
+    inconsistent_attributes=[
+        "databaseEdition",
+        "databaseEngine",
+        "database_engine",
+        "deploymentOption",
+        "engineCode",
+        "licenseModel",
+    ],
+    skipped_dimensions=offer_ingest.DEFAULT_SKIPPED_DIMENSIONS + ["storage"],
+    # skip multi-az
+    accept_product=lambda product: product["attributes"]["deploymentOption"]
+    == "Single-AZ",
+    accept_sku=accept_sku,
+    ondemand_keys=ondemand_keys,
+    reserved_keys=lambda attributes: [
+        attributes["database_engine"],
+        attributes["engineCode"],
+    ],
+)
+
+
+def scrape(output_file, input_file=None, ec2_data_file=None):
+    # EC2 specs are read from the EC2 instances.json next to the rds directory,
+    # e.g. www/instances.json for www/rds/instances.json, when it has been built
+    if ec2_data_file is None:
+        ec2_data_file = os.path.join(
+            os.path.dirname(os.path.dirname(output_file)), "instances.json"
+        )
 
-    # Parse reserved pricing
-    for sku, offers in six.iteritems(data["terms"]["Reserved"]):
-        for code, offer in six.iteritems(offers):
-            for key, dimension in six.iteritems(offer["priceDimensions"]):
-                instance = rds_instances.get(sku)
-                if not instance:
-                    # print(f"WARNING: Received reserved pricing info for unknown sku={sku}")
-                    continue
-
-                # skip multi-az
-                if instance["deploymentOption"] != "Single-AZ":
-                    continue
-
-                region = instance["region"]
-
-                # create a regional hash
-                if region not in instance["pricing"]:
-                    instance["pricing"][region] = {}
-
-                # create a database_engine hash
-                if instance["database_engine"] not in instance["pricing"][region]:
-                    instance["pricing"][region][instance["database_engine"]] = {}
-                if instance["engineCode"] not in instance["pricing"][region]:
-                    instance["pricing"][region][instance["engineCode"]] = {}
-
-                # create a reserved hash
-                if (
-                    "reserved"
-                    not in instances[instance["instance_type"]]["pricing"][
-                        instance["region"]
-                    ][instance["database_engine"]]
-                ):
-                    instances[instance["instance_type"]]["pricing"][instance["region"]][
-                        instance["database_engine"]
-                    ]["reserved"] = {}
-                if (
-                    "reserved"
-                    not in instances[instance["instance_type"]]["pricing"][
-                        instance["region"]
-                    ][instance["engineCode"]]
-                ):
-                    instances[instance["instance_type"]]["pricing"][instance["region"]][
-                        instance["engineCode"]
-                    ]["reserved"] = {}
-
-                reserved_type = "%s %s" % (
-                    offer["termAttributes"]["LeaseContractLength"],
-                    offer["termAttributes"]["PurchaseOption"],
-                )
-
-                instances[instance["instance_type"]]["pricing"][instance["region"]][
-                    instance["engineCode"]
-                ]["reserved"][
-                    "%s-%s"
-                    % (reserved_mapping[reserved_type], dimension["unit"].lower())
-                ] = float(
-                    dimension["pricePerUnit"]["USD"]
-                )
-                instances[instance["instance_type"]]["pricing"][instance["region"]][
-                    instance["database_engine"]
-                ]["reserved"][
-                    "%s-%s"
-                    % (reserved_mapping[reserved_type], dimension["unit"].lower())
-                ] = float(
-                    dimension["pricePerUnit"]["USD"]
-                )
-
-    # Calculate all reserved effective pricings (upfront hourly + hourly price)
-    for instance_type, instance in six.iteritems(instances):
-        for region, pricing in six.iteritems(instance["pricing"]):
-            for engine, prices in six.iteritems(pricing):
-                if "reserved" not in prices:
-                    continue
-                try:
-                    # no multi-az here
-                    reserved_prices = {}
-
-                    if "yrTerm3.partialUpfront-quantity" in prices["reserved"]:
-                        reserved_prices["yrTerm3Standard.partialUpfront"] = (
-                            prices["reserved"]["yrTerm3.partialUpfront-quantity"]
-                            / (365 * 3)
-                            / 24
-                        ) + prices["reserved"]["yrTerm3.partialUpfront-hrs"]
-
-                    if "yrTerm1.partialUpfront-quantity" in prices["reserved"]:
-                        reserved_prices["yrTerm1Standard.partialUpfront"] = (
-                            prices["reserved"]["yrTerm1.partialUpfront-quantity"]
-                            / 365
-                            / 24
-                        ) + prices["reserved"]["yrTerm1.partialUpfront-hrs"]
-
-                    if "yrTerm3.allUpfront-quantity" in prices["reserved"]:
-                        reserved_prices["yrTerm3Standard.allUpfront"] = (
-                            prices["reserved"]["yrTerm3.allUpfront-quantity"]
-                            / (365 * 3)
-                            / 24
-                        ) + prices["reserved"]["yrTerm3.allUpfront-hrs"]
-
-                    if "yrTerm1.allUpfront-quantity" in prices["reserved"]:
-                        reserved_prices["yrTerm1Standard.allUpfront"] = (
-                            prices["reserved"]["yrTerm1.allUpfront-quantity"] / 365 / 24
-                        ) + prices["reserved"]["yrTerm1.allUpfront-hrs"]
-
-                    if "yrTerm1.noUpfront-hrs" in prices["reserved"]:
-                        reserved_prices["yrTerm1Standard.noUpfront"] = prices[
-                            "reserved"
-                        ]["yrTerm1.noUpfront-hrs"]
-
-                    if "yrTerm3.noUpfront-hrs" in prices["reserved"]:
-                        reserved_prices["yrTerm3Standard.noUpfront"] = prices[
-                            "reserved"
-                        ]["yrTerm3.noUpfront-hrs"]
-
-                    instances[instance_type]["pricing"][region][engine][
-                        "reserved"
-                    ] = reserved_prices
-                except Exception as e:
-                    print(
-                        "ERROR: Trouble generating RDS reserved price for {}: {!r}".format(
-                            instance_type, e
-                        )
-                    )
+    # if an argument is given, use that as the path for the json file
+    instances = offer_ingest.ingest(RDS_OFFERS, input_file)
 
     add_pretty_names(instances)
     for i, v in instances.items():
@@ -382,7 +180,7 @@ def scrape(output_file, input_file=None):
         v["ebs_max_bandwidth"] = 0
         v["ebs_throughput"] = 0
         v["ebs_iops"] = 0
-    add_ebs_info(instances)
+    add_ebs_info(instances, ec2_data_file)
 
     # write output to file
     encoder.FLOAT_REPR = lambda o: format(o, ".5f")
@@ -1,19 +1,41 @@
-import mako.template
-import mako.lookup
 import mako.exceptions
+import concurrent.futures
 import io
 import json
 import datetime
 import os
-import copy
 import yaml
 import re
+import traceback
 
 from detail_pages_ec2 import build_detail_pages_ec2
 from detail_pages_rds import build_detail_pages_rds
 from detail_pages_cache import build_detail_pages_cache
 from detail_pages_opensearch import build_detail_pages_opensearch
 from detail_pages_redshift import build_detail_pages_redshift
+from precompress import compress_tree
+from template_registry import get_template
+
+# The services of the site: (data file, template, destination file)
+SERVICES = [
+    ("www/instances.json", "in/index.html.mako", "www/index.html"),
+    ("www/rds/instances.json", "in/rds.html.mako", "www/rds/index.html"),
+    ("www/cache/instances.json", "in/cache.html.mako", "www/cache/index.html"),
+    ("www/redshift/instances.json", "in/redshift.html.mako", "www/redshift/index.html"),
+    (
+        "www/opensearch/instances.json",
+        "in/opensearch.html.mako",
+        "www/opensearch/index.html",
+    ),
+]
+
+# Number of services rendered at the same time, each in its own process
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", "1"))
+
+# Number of EC2 instance rows inlined in index.html, the other rows are written to
+# instance-rows.html and loaded by default.js after the first paint. With 0 every
+# row is inlined.
+INDEX_INITIAL_ROWS = int(os.getenv("INDEX_INITIAL_ROWS", "0"))
 
 
 def network_sort(inst):
@@ -101,31 +123,72 @@ def _compress_pricing(d):
         yield nk, nv
 
 
-def compress_pricing(instances):
+def compress_prices(prices):
+    """Compress a dict of instance type to pricing, see compress_pricing"""
     global prices_index
 
-    prices = {i["instance_type"]: i["pricing"] for i in instances}
-
     prices_dict.clear()
     prices_index = 0
 
     return json.dumps({"index": prices_dict, "data": dict(_compress_pricing(prices))})
 
 
-def compress_instance_azs(instances):
-    instance_type_region_availability_zones = {}
-    for inst in instances:
-        if "instance_type" in inst and "availability_zones" in inst:
-            instance_type_region_availability_zones[inst["instance_type"]] = inst[
-                "availability_zones"
-            ]
-    return json.dumps(instance_type_region_availability_zones)
+def compress_pricing(instances):
+    prices = {i["instance_type"]: i["pricing"] for i in instances}
+    return compress_prices(prices)
+
+
+def _flatten_pricing(pricing, path=()):
+    for k, v in pricing.items():
+        if isinstance(v, dict):
+            yield from _flatten_pricing(v, path + (k,))
+        else:
+            yield path + (k,), v
+
+
+def columnar_pricing(region, prices):
+    """
+    Encode the pricing of one region, a dict of instance type to pricing, as
+    sparse rows which the web app looks prices up in with get_pricing().
+
+    Each instance type is a row and each (platform, term) a column, where the
+    platform is the first key of a price's path below the region (e.g. 'linux',
+    or 'ondemand' for services without platforms) and the term the rest of the
+    path joined by '/' (e.g. 'reserved/yrTerm1Standard.noUpfront'). Instance
+    types only have prices for some of the columns, so a row lists its prices
+    as [column step, price, ...] pairs by increasing column, the step being the
+    distance from the previous column of the row (or from -1 for the first).
+    """
+    columns = {}
+    rows = []
+
+    for pricing in prices.values():
+        row = {}
+        for path, value in _flatten_pricing(pricing):
+            column = columns.setdefault((path[0], "/".join(path[1:])), len(columns))
+            row[column] = value
+        cells = []
+        previous = -1
+        for column in sorted(row):
+            cells.extend((column - previous, row[column]))
+            previous = column
+        rows.append(cells)
+
+    return json.dumps(
+        {
+            "region": region,
+            "instances": list(prices),
+            "platforms": [platform for platform, _ in columns],
+            "terms": [term for _, term in columns],
+            "prices": rows,
+        },
+        separators=(",", ":"),
+    )
 
 
 def about_page(destination_file="www/about.html"):
     print("Rendering to %s..." % destination_file)
-    lookup = mako.lookup.TemplateLookup(directories=["."])
-    template = mako.template.Template(filename="in/about.html.mako", lookup=lookup)
+    template = get_template("in/about.html.mako")
     generated_at = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
     os.makedirs(os.path.dirname(destination_file), exist_ok=True)
     with io.open(destination_file, "w+", encoding="utf-8") as fh:
@@ -157,44 +220,56 @@ def per_region_pricing(instances, data_file, all_regions):
     # disk and then can be loaded by the web app to reduce the amount of data that
     # needs to be sent to the client.
 
+    # The columnar pricing of us-east-1 is embedded in the page and the other
+    # regions are fetched from pricing_columnar_<region>.json. The nested
+    # pricing_<region>.json files are still written for other consumers.
     init_pricing_json = ""
     init_instance_azs_json = ""
 
     outdir = data_file.replace("instances.json", "")
 
-    instances_no_pricing = copy.deepcopy(instances)
-    for i in instances_no_pricing:
-        if "pricing" in i:
-            del i["pricing"]
-        if "availability_zones" in i:
-            del i["availability_zones"]
+    # Every instance type is listed in every region file, with empty pricing and
+    # availability zones where it isn't offered. A later instance with the same
+    # type replaces an earlier one, as in compress_pricing.
+    by_type = {i["instance_type"]: i for i in instances}
+    empty = {instance_type: {} for instance_type in by_type}
+
+    # Bucket the pricing and availability zones of each instance by region in a
+    # single pass, instead of walking all instances again for every region
+    region_pricing = {r: {} for r in all_regions}
+    region_azs = {r: {} for r in all_regions}
+    for instance_type, inst in by_type.items():
+        for r, pricing in inst["pricing"].items():
+            if r in region_pricing:
+                region_pricing[r][instance_type] = {r: pricing}
+        for r, azs in inst.get("availability_zones", {}).items():
+            if r in region_azs:
+                region_azs[r][instance_type] = {r: azs}
 
     for r in all_regions:
-        per_region_out = {}
-        per_region_out = instances_no_pricing
-
-        for i, inst in enumerate(instances):
-            per_region_out[i]["pricing"] = {}
-            per_region_out[i]["availability_zones"] = {}
-            if r in inst["pricing"]:
-                per_region_out[i]["pricing"][r] = instances[i]["pricing"][r]
-            if "availability_zones" in inst and r in inst["availability_zones"]:
-                per_region_out[i]["availability_zones"][r] = instances[i][
-                    "availability_zones"
-                ][r]
+        prices = dict(empty)
+        prices.update(region_pricing[r])
+        instance_azs = dict(empty)
+        instance_azs.update(region_azs[r])
 
         pricing_out_file = "{}pricing_{}.json".format(outdir, r)
+        columnar_out_file = "{}pricing_columnar_{}.json".format(outdir, r)
         azs_out_file = "{}instance_azs_{}.json".format(outdir, r)
 
-        pricing_json = compress_pricing(per_region_out)
-        instance_azs_json = compress_instance_azs(per_region_out)
+        pricing_json = compress_prices(prices)
+        columnar_json = columnar_pricing(
+            r, {t: p[r] for t, p in region_pricing[r].items()}
+        )
+        instance_azs_json = json.dumps(instance_azs)
 
         if r == "us-east-1":
-            init_pricing_json = pricing_json
+            init_pricing_json = columnar_json
             init_instance_azs_json = instance_azs_json
 
         with open(pricing_out_file, "w+") as f:
             f.write(pricing_json)
+        with open(columnar_out_file, "w+") as f:
+            f.write(columnar_json)
         with open(azs_out_file, "w+") as f:
             f.write(instance_azs_json)
 
@@ -224,10 +299,27 @@ def regions_list(instances):
     return regions
 
 
-def render(data_file, template_file, destination_file, detail_pages=True):
-    """Build the HTML content from scraped data"""
-    lookup = mako.lookup.TemplateLookup(directories=["."])
-    template = mako.template.Template(filename=template_file, lookup=lookup)
+def render_deferred_rows(template, instances, rows_file):
+    """
+    Render the instance table rows that aren't inlined in the page to rows_file
+    and return its URL. Indentation is dropped as it doesn't change the rows.
+    """
+    rows = template.get_def("instance_rows").render(instances=instances)
+    with io.open(rows_file, "w+", encoding="utf-8") as fh:
+        fh.write(re.sub(r"\s*\n\s*", "\n", rows).strip() + "\n")
+    return "/" + os.path.relpath(rows_file, "www")
+
+
+def render(
+    data_file, template_file, destination_file, detail_pages=True, incremental=False
+):
+    """
+    Build the HTML content from scraped data
+
+    With incremental, detail pages whose inputs are unchanged since the last
+    render are not rendered again.
+    """
+    template = get_template(template_file)
     with open(data_file, "r") as f:
         instances = json.load(f)
 
@@ -243,24 +335,40 @@ def render(data_file, template_file, destination_file, detail_pages=True):
         all_regions.update(regions["local_zone"])
         all_regions.update(regions["wavelength"])
         if detail_pages:
-            sitemap.extend(build_detail_pages_ec2(instances, all_regions))
+            sitemap.extend(
+                build_detail_pages_ec2(instances, all_regions, incremental=incremental)
+            )
     elif data_file == "www/rds/instances.json":
         all_regions = regions["main"].copy()
         all_regions.update(regions["local_zone"])
         if detail_pages:
-            sitemap.extend(build_detail_pages_rds(instances, all_regions))
+            sitemap.extend(
+                build_detail_pages_rds(instances, all_regions, incremental=incremental)
+            )
     elif data_file == "www/cache/instances.json":
         all_regions = regions["main"].copy()
         if detail_pages:
-            sitemap.extend(build_detail_pages_cache(instances, all_regions))
+            sitemap.extend(
+                build_detail_pages_cache(
+                    instances, all_regions, incremental=incremental
+                )
+            )
     elif data_file == "www/opensearch/instances.json":
         all_regions = regions["main"].copy()
         if detail_pages:
-            sitemap.extend(build_detail_pages_opensearch(instances, all_regions))
+            sitemap.extend(
+                build_detail_pages_opensearch(
+                    instances, all_regions, incremental=incremental
+                )
+            )
     elif data_file == "www/redshift/instances.json":
         all_regions = regions["main"].copy()
         if detail_pages:
-            sitemap.extend(build_detail_pages_redshift(instances, all_regions))
+            sitemap.extend(
+                build_detail_pages_redshift(
+                    instances, all_regions, incremental=incremental
+                )
+            )
 
     generated_at = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
     pricing_json, instance_azs_json = per_region_pricing(
@@ -271,6 +379,19 @@ def render(data_file, template_file, destination_file, detail_pages=True):
     os.makedirs(os.path.dirname(destination_file), exist_ok=True)
     with io.open(destination_file, "w+", encoding="utf-8") as fh:
         try:
+            initial_rows = 0
+            rows_url = ""
+            if data_file == "www/instances.json" and 0 < INDEX_INITIAL_ROWS < len(
+                instances
+            ):
+                initial_rows = INDEX_INITIAL_ROWS
+                rows_url = render_deferred_rows(
+                    template,
+                    instances[initial_rows:],
+                    os.path.join(
+                        os.path.dirname(destination_file), "instance-rows.html"
+                    ),
+                )
             fh.write(
                 template.render(
                     instances=instances,
@@ -278,6 +399,8 @@ def render(data_file, template_file, destination_file, detail_pages=True):
                     pricing_json=pricing_json,
                     generated_at=generated_at,
                     instance_azs_json=instance_azs_json,
+                    initial_rows=initial_rows,
+                    rows_url=rows_url,
                 )
             )
             sitemap.append(destination_file)
@@ -287,32 +410,62 @@ def render(data_file, template_file, destination_file, detail_pages=True):
     return sitemap
 
 
-if __name__ == "__main__":
-    sitemap = []
-    sitemap.extend(render("www/instances.json", "in/index.html.mako", "www/index.html"))
-    sitemap.extend(
-        render("www/rds/instances.json", "in/rds.html.mako", "www/rds/index.html")
-    )
-    sitemap.extend(
-        render(
-            "www/cache/instances.json",
-            "in/cache.html.mako",
-            "www/cache/index.html",
-        )
-    )
-    sitemap.extend(
-        render(
-            "www/redshift/instances.json",
-            "in/redshift.html.mako",
-            "www/redshift/index.html",
-        )
-    )
-    sitemap.extend(
-        render(
-            "www/opensearch/instances.json",
-            "in/opensearch.html.mako",
-            "www/opensearch/index.html",
+def render_service(data_file, template_file, destination_file, incremental=False):
+    """Render one service, returns its sitemap and the error if it failed"""
+    try:
+        sitemap = render(
+            data_file, template_file, destination_file, incremental=incremental
         )
-    )
+    except Exception:
+        return [], traceback.format_exc()
+    return sitemap, None
+
+
+def render_services(services=SERVICES, processes=None, incremental=False):
+    """
+    Render every service and return their combined sitemap.
+
+    With more than one process the services are rendered in parallel in
+    separate processes. A service that fails to render is reported without
+    stopping the others, and RuntimeError raised once all of them are done.
+    """
+    if processes is None:
+        processes = RENDER_PROCESSES
+
+    results = []
+    if processes <= 1:
+        for service in services:
+            results.append(render_service(*service, incremental=incremental))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(processes, len(services))
+        ) as executor:
+            futures = [
+                executor.submit(render_service, *service, incremental=incremental)
+                for service in services
+            ]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception:
+                    # The worker process died, e.g. it ran out of memory
+                    results.append(([], traceback.format_exc()))
+
+    sitemap = []
+    failed = []
+    for (data_file, _, _), (service_sitemap, error) in zip(services, results):
+        if error:
+            print("ERROR: Unable to render %s" % data_file)
+            print(error)
+            failed.append(data_file)
+        sitemap.extend(service_sitemap)
+    if failed:
+        raise RuntimeError("Unable to render %s" % ", ".join(failed))
+    return sitemap
+
+
+if __name__ == "__main__":
+    sitemap = render_services()
     sitemap.append(about_page())
     build_sitemap(sitemap)
+    compress_tree("www")
@@ -5,12 +5,13 @@ import json
 import locale
 import gzip
 import ec2
+import http_cache
 import os
 import requests
 import pickle
 import boto3
 import botocore
-from six.moves.urllib import request as urllib2
+import concurrent.futures
 from ec2_gpu_info import add_gpu_info
 
 # Following advice from https://stackoverflow.com/a/1779324/216138
@@ -264,12 +265,12 @@ def add_ebs_pricing(imap, data):
                     inst.pricing[region]["ebs"] = col["prices"]["USD"]
 
 
-def add_pricing_info(instances):
+def add_pricing_info(instances, pricing_source="api"):
     for i in instances:
         i.pricing = {}
 
     by_type = {i.instance_type: i for i in instances}
-    ec2.add_pricing(by_type)
+    ec2.add_pricing(by_type, pricing_source)
 
     # EBS cost surcharge as per https://aws.amazon.com/ec2/pricing/on-demand/#EBS-Optimized_Instances
     ebs_pricing_url = (
@@ -279,9 +280,8 @@ def add_pricing_info(instances):
     add_ebs_pricing(by_type, pricing)
 
 
-def fetch_data(url):
-    response = urllib2.urlopen(url).read()
-
+def parse_data(response):
+    """Decode a pricing file body that may be gzipped, JSON or JSONP"""
     try:
         content = response.decode()
     except UnicodeDecodeError:
@@ -300,36 +300,37 @@ def fetch_data(url):
     return pricing
 
 
-def add_eni_info(instances):
-    client = create_boto3_client("ec2", region_name="us-east-1")
-    pager = client.get_paginator("describe_instance_types")
-    responses = pager.paginate(Filters=[{"Name": "instance-type", "Values": ["*"]}])
-    for response in responses:
-        instance_types = response["InstanceTypes"]
+def fetch_data(url, session=None):
+    """Fetch and decode a pricing file, reusing the connections of session if given"""
+    return parse_data(http_cache.fetch(url, session))
 
-        by_type = {i.instance_type: i for i in instances}
 
-        for instance_type_info in instance_types:
-            instance_type = instance_type_info["InstanceType"]
-            max_enis = instance_type_info["NetworkInfo"]["MaximumNetworkInterfaces"]
-            ip_per_eni = instance_type_info["NetworkInfo"]["Ipv4AddressesPerInterface"]
+def add_eni_info(instances, instance_types=None):
+    if instance_types is None:
+        instance_types = ec2.describe_instance_types()
 
-            if instance_type not in by_type:
-                print(
-                    "WARNING: Ignoring data for unknown instance type: {}".format(
-                        instance_type
-                    )
-                )
-                continue
+    by_type = {i.instance_type: i for i in instances}
 
-            if not by_type[instance_type].vpc:
-                print(
-                    f"WARNING: DescribeInstanceTypes API does not have network info for {instance_type}, scraping instead"
+    for instance_type, instance_type_info in instance_types.items():
+        max_enis = instance_type_info["NetworkInfo"]["MaximumNetworkInterfaces"]
+        ip_per_eni = instance_type_info["NetworkInfo"]["Ipv4AddressesPerInterface"]
+
+        if instance_type not in by_type:
+            print(
+                "WARNING: Ignoring data for unknown instance type: {}".format(
+                    instance_type
                 )
-                by_type[instance_type].vpc = {
-                    "max_enis": max_enis,
-                    "ips_per_eni": ip_per_eni,
-                }
+            )
+            continue
+
+        if not by_type[instance_type].vpc:
+            print(
+                f"WARNING: DescribeInstanceTypes API does not have network info for {instance_type}, scraping instead"
+            )
+            by_type[instance_type].vpc = {
+                "max_enis": max_enis,
+                "ips_per_eni": ip_per_eni,
+            }
 
 
 def add_linux_ami_info(instances):
@@ -341,7 +342,7 @@ def add_linux_ami_info(instances):
     """
     checkmark_char = "\u2713"
     url = "http://aws.amazon.com/amazon-linux-ami/instance-type-matrix/"
-    tree = etree.parse(urllib2.urlopen(url), etree.HTMLParser())
+    tree = etree.parse(http_cache.open_url(url), etree.HTMLParser())
     table = tree.xpath('//div[@class="aws-table"]/table')[0]
     rows = table.xpath(".//tr[./td]")[1:]  # ignore header
 
@@ -408,35 +409,28 @@ def add_vpconly_detail(instances):
                 i.vpc_only = False
 
 
-def add_instance_storage_details(instances):
+def add_instance_storage_details(instances, instance_types=None):
     """Add information about instance storage features."""
-    client = create_boto3_client("ec2", region_name="us-east-1")
-    pager = client.get_paginator("describe_instance_types")
-    responses = pager.paginate(
-        Filters=[
-            {"Name": "instance-storage-supported", "Values": ["true"]},
-            {"Name": "instance-type", "Values": ["*"]},
-        ]
-    )
+    if instance_types is None:
+        instance_types = ec2.describe_instance_types()
 
-    for response in responses:
-        instance_types = response["InstanceTypes"]
+    for i in instances:
+        instance_type = instance_types.get(i.instance_type)
+        if not instance_type or not instance_type.get("InstanceStorageSupported"):
+            continue
 
-        for i in instances:
-            for instance_type in instance_types:
-                if i.instance_type == instance_type["InstanceType"]:
-                    storage_info = instance_type["InstanceStorageInfo"]
+        storage_info = instance_type["InstanceStorageInfo"]
 
-                    if storage_info:
-                        nvme_support = storage_info["NvmeSupport"]
-                        disk = storage_info["Disks"][0]
+        if storage_info:
+            nvme_support = storage_info["NvmeSupport"]
+            disk = storage_info["Disks"][0]
 
-                        i.ebs_only = False
-                        i.num_drives = disk["Count"]
-                        i.drive_size = disk["SizeInGB"]
-                        i.size_unit = "GB"
-                        i.ssd = "ssd" == disk["Type"]
-                        i.nvme_ssd = nvme_support in ["supported", "required"]
+            i.ebs_only = False
+            i.num_drives = disk["Count"]
+            i.drive_size = disk["SizeInGB"]
+            i.size_unit = "GB"
+            i.ssd = "ssd" == disk["Type"]
+            i.nvme_ssd = nvme_support in ["supported", "required"]
 
 
 def add_t2_credits(instances):
@@ -445,7 +439,7 @@ def add_t2_credits(instances):
     # url = "https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/burstable-credits-baseline-concepts.partial.html"
     # It seems it's no longer dynamically loaded
     url = "http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/t2-credits-baseline-concepts.html"
-    tree = etree.parse(urllib2.urlopen(url), etree.HTMLParser())
+    tree = etree.parse(http_cache.open_url(url), etree.HTMLParser())
     table = tree.xpath('//div[@class="table-contents"]//table')[1]
     rows = table.xpath(".//tr[./td]")
     assert len(rows) > 0, "Failed to find T2 CPU credit info"
@@ -553,36 +547,52 @@ def add_emr_info(instances):
                 pass
 
 
-def add_availability_zone_info(instances):
+def get_region_availability_zones(region_name):
+    """Return the (instance type, availability zone id) offerings of a region"""
+    return [
+        (offering["InstanceType"], offering["Location"])
+        for offering in ec2.describe_instance_type_offerings(
+            region_name=region_name, location_type="availability-zone-id"
+        )
+    ]
+
+
+def add_availability_zone_info(instances, max_workers=16):
     """
     Add info about availability zones using information from the following APIs:
         - aws ec2 describe-instance-type-offerings --region us-east-1
         - aws ec2 describe-instance-type-offerings --location-type availability-zone --region us-east-1
         - aws ec2 describe-availability-zones --region us-east-1
     https://docs.aws.amazon.com/cli/latest/reference/ec2/describe-instance-type-offerings.html
+
+    All regions are queried in parallel, using at most max_workers threads.
     """
     instance_type_region_availability_zones = {}
-    for region_name in ec2.describe_regions():
-        for offering in ec2.describe_instance_type_offerings(
-            region_name=region_name, location_type="availability-zone-id"
-        ):
-            instance_type = offering["InstanceType"]
-            availability_zone_id = offering["Location"]
-            region_availability_zones = instance_type_region_availability_zones.get(
-                instance_type, {}
-            )
-            availability_zones = region_availability_zones.get(region_name, [])
-            if availability_zone_id not in availability_zones:
-                availability_zones.append(availability_zone_id)
-                availability_zones.sort()
-                region_availability_zones[region_name] = availability_zones
-                instance_type_region_availability_zones[instance_type] = (
-                    region_availability_zones
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_region = {
+            executor.submit(get_region_availability_zones, region_name): region_name
+            for region_name in ec2.describe_regions()
+        }
+        # Merged in region order, so the regions keep their order between runs
+        for future, region_name in future_to_region.items():
+            for instance_type, availability_zone_id in future.result():
+                region_availability_zones = (
+                    instance_type_region_availability_zones.setdefault(
+                        instance_type, {}
+                    )
+                )
+                region_availability_zones.setdefault(region_name, set()).add(
+                    availability_zone_id
                 )
+
     for inst in instances:
-        inst.availability_zones = instance_type_region_availability_zones.get(
+        region_availability_zones = instance_type_region_availability_zones.get(
             inst.instance_type, {}
         )
+        inst.availability_zones = {
+            region_name: sorted(availability_zones)
+            for region_name, availability_zones in region_availability_zones.items()
+        }
 
 
 def add_placement_groups(instances):
@@ -654,77 +664,95 @@ def add_dedicated_info(instances):
     def format_price(price):
         return str(float("%f" % float(price))).rstrip("0").rstrip(".")
 
-    def fetch_dedicated_prices():
+    def fetch_dedicated_prices(max_workers=16):
         all_pricing = {}
+        session = http_cache.create_session(max_connections=max_workers)
 
         # On demand pricing, not all dedicated instances are available on demand
         url = "https://b0.p.awsstatic.com/pricing/2.0/meteredUnitMaps/ec2/USD/current/dedicatedhost-ondemand.json"
-        od_pricing = fetch_data(url)
+        od_pricing = fetch_data(url, session)
 
-        # Create a mapping between human-readable regions and API region names
-        region_to_api_region = {}
         for region in od_pricing["regions"]:
             all_pricing[region] = {}
-            # Store this mapping for later use
-            region_to_api_region[region] = region
 
             for instance_description, dinst in od_pricing["regions"][region].items():
                 _price = {"ondemand": format_price(dinst["price"]), "reserved": {}}
                 all_pricing[region][dinst["Instance Type"]] = _price
 
         # All of the reserved pricing is at different URLs
-        for region in od_pricing["regions"]:
-            for term in ["3 year", "1 year"]:
-                for payment in ["No Upfront", "Partial Upfront", "All Upfront"]:
-                    base = f"https://b0.p.awsstatic.com/pricing/2.0/meteredUnitMaps/ec2/USD/current/dedicatedhost-reservedinstance-virtual/"
-                    path = f"{region}/{term}/{payment}/index.json".replace(" ", "%20")
-
-                    try:
-                        pricing = fetch_data(base + path)
-                    except:
-                        print(
-                            "WARNING: Ignoring pricing - dedicated host. region={}, term={}, payment={}".format(
-                                region, term, payment
-                            )
-                        )
-                        continue
-
-                    for instance_description, dinst in pricing["regions"][
-                        region
-                    ].items():
-                        # Similar to get_reserved_pricing in ec2.py the goal is to get the effective hourly rate
-                        # and then the frontend will deal with making it monthly, yearly etc
-                        upfront = 0.0
-                        if "Partial" in payment or "All" in payment:
-                            upfront = float(dinst["riupfront:PricePerUnit"])
-                        inst_type = dinst["Instance Type"]
-                        ondemand = float(dinst["price"])
-                        lease_in_years = int(dinst["LeaseContractLength"][0])
-                        hours_in_term = lease_in_years * 365 * 24
-                        price = float(ondemand) + (float(upfront) / hours_in_term)
-                        translate_ri = reserved_map[
-                            dinst["LeaseContractLength"] + dinst["PurchaseOption"]
-                        ]
+        base = f"https://b0.p.awsstatic.com/pricing/2.0/meteredUnitMaps/ec2/USD/current/dedicatedhost-reservedinstance-virtual/"
+        reserved_files = [
+            (region, term, payment)
+            for region in od_pricing["regions"]
+            for term in ["3 year", "1 year"]
+            for payment in ["No Upfront", "Partial Upfront", "All Upfront"]
+        ]
+
+        def fetch_reserved_file(reserved_file):
+            region, term, payment = reserved_file
+            path = f"{region}/{term}/{payment}/index.json".replace(" ", "%20")
+            return fetch_data(base + path, session)
 
-                        # Certain instances will not have been created above because they are not available on demand
-                        if inst_type not in all_pricing[region]:
-                            all_pricing[region][inst_type] = {"reserved": {}}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Keep the original ordering when merging the results
+            futures = [
+                executor.submit(fetch_reserved_file, reserved_file)
+                for reserved_file in reserved_files
+            ]
 
-                        all_pricing[region][inst_type]["reserved"][translate_ri] = (
-                            format_price(price)
+            for (region, term, payment), future in zip(reserved_files, futures):
+                try:
+                    pricing = future.result()
+                except:
+                    print(
+                        "WARNING: Ignoring pricing - dedicated host. region={}, term={}, payment={}".format(
+                            region, term, payment
                         )
+                    )
+                    continue
+
+                for instance_description, dinst in pricing["regions"][region].items():
+                    # Similar to get_reserved_pricing in ec2.py the goal is to get the effective hourly rate
+                    # and then the frontend will deal with making it monthly, yearly etc
+                    upfront = 0.0
+                    if "Partial" in payment or "All" in payment:
+                        upfront = float(dinst["riupfront:PricePerUnit"])
+                    inst_type = dinst["Instance Type"]
+                    ondemand = float(dinst["price"])
+                    lease_in_years = int(dinst["LeaseContractLength"][0])
+                    hours_in_term = lease_in_years * 365 * 24
+                    price = float(ondemand) + (float(upfront) / hours_in_term)
+                    translate_ri = reserved_map[
+                        dinst["LeaseContractLength"] + dinst["PurchaseOption"]
+                    ]
 
-        return all_pricing, region_to_api_region
+                    # Certain instances will not have been created above because they are not available on demand
+                    if inst_type not in all_pricing[region]:
+                        all_pricing[region][inst_type] = {"reserved": {}}
 
-    all_pricing, region_to_api_region = fetch_dedicated_prices()
+                    all_pricing[region][inst_type]["reserved"][translate_ri] = (
+                        format_price(price)
+                    )
 
-    # Create a reverse mapping from human-readable region to API region name
-    human_to_api_region = {}
-    for api_region, region_data in all_pricing.items():
-        for desc_region, region_code in region_map.items():
-            canonical_region = ec2.canonicalize_location(desc_region, False)
-            if canonical_region and api_region in canonical_region:
-                human_to_api_region[desc_region] = api_region
+        return all_pricing
+
+    all_pricing = fetch_dedicated_prices()
+
+    # The dedicated host files use human-readable region names. Resolve each region
+    # to its dedicated pricing once instead of scanning all_pricing for every instance.
+    api_regions = {}
+
+    def find_api_region(region):
+        if region not in api_regions:
+            api_regions[region] = None
+            canonical_region = ec2.canonicalize_location(
+                region_map.get(region, region), False
+            )
+            for ar in all_pricing.keys():
+                if ar in canonical_region:
+                    api_regions[region] = ar
+                    break
+        return api_regions[region]
 
     for inst in instances:
         if not inst.pricing:
@@ -734,18 +762,11 @@ def add_dedicated_info(instances):
             # previous dedicated pricing dict we have built is by region.
             inst_type = inst.instance_type.split(".")[0]
             for k, r in region_map.items():
-                region = ec2.canonicalize_location(r, False)
-
-                # Look up the correct API region name
-                api_region = None
-                for ar in all_pricing.keys():
-                    if ar in region:
-                        api_region = ar
-                        break
+                api_region = find_api_region(k)
 
                 if api_region and inst_type in all_pricing[api_region]:
                     _price = all_pricing[api_region][inst_type]
-                    inst.regions[k] = region
+                    inst.regions[k] = ec2.canonicalize_location(r, False)
                     inst.pricing[k] = {}
                     inst.pricing[k]["dedicated"] = _price
         else:
@@ -754,16 +775,7 @@ def add_dedicated_info(instances):
                 # Dedicated hosts are not associated with any type of software like rhel or mswin
                 # Not all instances are available as dedicated hosts
                 try:
-                    # Look up the API region name from the human-readable region
-                    api_region = None
-                    canonical_region = ec2.canonicalize_location(
-                        region_map.get(region, region), False
-                    )
-
-                    for ar in all_pricing.keys():
-                        if ar in canonical_region:
-                            api_region = ar
-                            break
+                    api_region = find_api_region(region)
 
                     if (
                         api_region
@@ -828,39 +840,162 @@ def add_spot_interrupt_info(instances):
                     instance.pricing[region][os_id]["spot_avg"] = f"{est_spot:.6f}"
 
 
-def scrape(data_file):
-    """Scrape AWS to get instance data"""
+class Stage(object):
+    """A scrape step along with the Instance attributes it reads and writes"""
+
+    def __init__(self, description, function, reads=(), writes=()):
+        self.description = description
+        self.function = function
+        self.reads = set(reads)
+        self.writes = set(writes)
+
+    def conflicts_with(self, other):
+        """Whether the two stages can't run at the same time"""
+        return bool(
+            self.writes & (other.reads | other.writes) or self.reads & other.writes
+        )
+
+    def __repr__(self):
+        return "<Stage {}>".format(self.description)
+
+
+def run_stages(stages, instances, max_workers=8):
+    """
+    Run the stages over the instances, concurrently where possible.
+
+    A stage waits for every stage listed before it that it conflicts with, so the
+    result is the same as running them one after another in the given order.
+    """
+    dependencies = {
+        stage: {earlier for earlier in stages[:n] if earlier.conflicts_with(stage)}
+        for n, stage in enumerate(stages)
+    }
+    pending = list(stages)
+    done = set()
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for stage in list(pending):
+                if dependencies[stage] <= done:
+                    print(stage.description)
+                    running[executor.submit(stage.function, instances)] = stage
+                    pending.remove(stage)
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    print("ERROR: Stage failed: {}".format(stage.description))
+                    for f in running:
+                        f.cancel()
+                    raise
+                done.add(stage)
+
+
+def scrape(data_file, max_workers=8, pricing_source="api"):
+    """
+    Scrape AWS to get instance data
+
+    pricing_source is either "api" to read EC2 prices from the Pricing API or
+    "bulk" to stream them from the bulk offer files.
+    """
+    print("Listing instance types...")
+    instance_types = ec2.describe_instance_types()
     print("Parsing instance types...")
-    all_instances = ec2.get_instances()
-    print("Parsing pricing info...")
-    add_pricing_info(all_instances)
-    print("Parsing ENI info...")
-    add_eni_info(all_instances)
-    print("Parsing Linux AMI info...")
-    add_linux_ami_info(all_instances)
-    print("Parsing VPC-only info...")
-    add_vpconly_detail(all_instances)
-    print("Parsing local instance storage...")
-    add_instance_storage_details(all_instances)
-    print("Parsing burstable instance credits...")
-    add_t2_credits(all_instances)
-    print("Parsing instance names...")
-    add_pretty_names(all_instances)
-    print("Parsing emr details...")
-    add_emr_info(all_instances)
-    print("Adding GPU details...")
-    add_gpu_info(all_instances)
-    print("Adding availability zone details...")
-    add_availability_zone_info(all_instances)
-    print("Adding placement group details...")
-    add_placement_groups(all_instances)
-    print("Adding dedicated host pricing...")
-    add_dedicated_info(all_instances)
-    print("Adding spot interrupt details...")
-    add_spot_interrupt_info(all_instances)
+    all_instances = ec2.get_instances(instance_types)
+
+    # Prices are written by several stages, which therefore run in this order
+    stages = [
+        Stage(
+            "Parsing pricing info...",
+            lambda instances: add_pricing_info(instances, pricing_source),
+            reads=["instance_type"],
+            writes=["pricing", "regions"],
+        ),
+        Stage(
+            "Parsing ENI info...",
+            lambda instances: add_eni_info(instances, instance_types),
+            reads=["instance_type", "vpc"],
+            writes=["vpc"],
+        ),
+        Stage(
+            "Parsing Linux AMI info...",
+            add_linux_ami_info,
+            reads=["instance_type", "linux_virtualization_types"],
+            writes=["linux_virtualization_types"],
+        ),
+        Stage(
+            "Parsing VPC-only info...",
+            add_vpconly_detail,
+            reads=["instance_type"],
+            writes=["vpc_only"],
+        ),
+        Stage(
+            "Parsing local instance storage...",
+            lambda instances: add_instance_storage_details(instances, instance_types),
+            reads=["instance_type"],
+            writes=["storage"],
+        ),
+        Stage(
+            "Parsing burstable instance credits...",
+            add_t2_credits,
+            reads=["instance_type", "vCPU"],
+            writes=["base_performance", "burst_minutes"],
+        ),
+        Stage(
+            "Parsing instance names...",
+            add_pretty_names,
+            reads=["instance_type"],
+            writes=["pretty_name"],
+        ),
+        Stage(
+            "Parsing emr details...",
+            add_emr_info,
+            reads=["instance_type", "pricing"],
+            writes=["pricing", "emr"],
+        ),
+        Stage(
+            "Adding GPU details...",
+            add_gpu_info,
+            reads=["instance_type", "GPU"],
+            writes=["GPU"],
+        ),
+        Stage(
+            "Adding availability zone details...",
+            add_availability_zone_info,
+            reads=["instance_type"],
+            writes=["availability_zones"],
+        ),
+        Stage(
+            "Adding placement group details...",
+            add_placement_groups,
+            reads=["instance_type", "generation"],
+            writes=["placement_group_support"],
+        ),
+        Stage(
+            "Adding dedicated host pricing...",
+            add_dedicated_info,
+            reads=["instance_type", "pricing"],
+            writes=["pricing", "regions"],
+        ),
+        Stage(
+            "Adding spot interrupt details...",
+            add_spot_interrupt_info,
+            reads=["instance_type", "pricing"],
+            writes=["pricing"],
+        ),
+    ]
+    run_stages(stages, all_instances, max_workers)
 
     os.makedirs(os.path.dirname(data_file), exist_ok=True)
-    with open(data_file, "w+") as f:
+    # Replace the data file at once, others like the RDS scraper may be reading it
+    tmp_path = f"{data_file}.{os.getpid()}.tmp"
+    with open(tmp_path, "w+") as f:
         json.dump(
             [i.to_dict() for i in all_instances],
             f,
@@ -868,6 +1003,7 @@ def scrape(data_file):
             sort_keys=True,
             separators=(",", ": "),
         )
+    os.replace(tmp_path, data_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+"""
+Indexed queries over the instances of a service, e.g. the current generation EC2
+instances with at least 16 vCPUs and 64 GiB of memory under $1 an hour on Linux
+in eu-west-1, cheapest first:
+
+    from ec2instances.info import index
+
+    index("ec2").find(
+        min_vcpu=16,
+        min_memory=64,
+        region="eu-west-1",
+        platform="linux",
+        max_price=1.0,
+        generation="current",
+    )
+
+scripts/package.py ships this module as ec2instances/info/query.py.
+"""
+
+import bisect
+import threading
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SortedIndex(object):
+    """Positions of instances sorted by a numeric value, for range lookups"""
+
+    def __init__(self, values):
+        pairs = sorted(values)
+        self.keys = [value for value, _ in pairs]
+        self.positions = [position for _, position in pairs]
+
+    def between(self, low=None, high=None):
+        """Positions with a value from low to high, both included, in value order"""
+        start = 0 if low is None else bisect.bisect_left(self.keys, low)
+        end = len(self.keys) if high is None else bisect.bisect_right(self.keys, high)
+        return self.positions[start:end]
+
+
+class InstanceIndex(object):
+    """
+    Indexes over a list of instances, like ec2instances.info.ec2.
+
+    The instance types, families and regions are hashed, and the vCPUs and
+    memory are sorted when the index is built. The prices of a (region,
+    platform, term) are sorted the first time they are queried. The platform is
+    the key the prices of a region are grouped by, e.g. 'linux' for EC2 or the
+    engine for RDS, and the term either 'ondemand' or a reserved term like
+    'yrTerm1Standard.noUpfront'.
+    """
+
+    def __init__(self, instances):
+        self.instances = instances
+        self.by_type = {}
+        self.by_family = {}
+        self.by_region = {}
+        vcpus = []
+        memory = []
+        for position, instance in enumerate(instances):
+            self.by_type[instance["instance_type"]] = instance
+            self.by_family.setdefault(instance.get("family"), []).append(position)
+            for region in instance.get("pricing", {}):
+                self.by_region.setdefault(region, []).append(position)
+            vcpu = _number(instance.get("vCPU", instance.get("vcpu")))
+            if vcpu is not None:
+                vcpus.append((vcpu, position))
+            instance_memory = _number(instance.get("memory"))
+            if instance_memory is not None:
+                memory.append((instance_memory, position))
+        self.vcpus = SortedIndex(vcpus)
+        self.memory = SortedIndex(memory)
+
+        self.prices = {}
+        self.prices_lock = threading.Lock()
+
+    def get(self, instance_type):
+        """Return the instance of an instance type, or None"""
+        return self.by_type.get(instance_type)
+
+    def price(self, instance, region, platform, term="ondemand"):
+        """Return the hourly price of an instance, or None if it isn't offered"""
+        pricing = instance.get("pricing", {}).get(region, {}).get(platform)
+        if not isinstance(pricing, dict):
+            return None
+        if term == "ondemand":
+            return _number(pricing.get("ondemand"))
+        return _number(pricing.get("reserved", {}).get(term))
+
+    def price_index(self, region, platform, term="ondemand"):
+        key = (region, platform, term)
+        with self.prices_lock:
+            if key not in self.prices:
+                prices = []
+                for position, instance in enumerate(self.instances):
+                    price = self.price(instance, region, platform, term)
+                    if price is not None:
+                        prices.append((price, position))
+                self.prices[key] = SortedIndex(prices)
+            return self.prices[key]
+
+    def find(
+        self,
+        family=None,
+        min_vcpu=None,
+        max_vcpu=None,
+        min_memory=None,
+        max_memory=None,
+        region=None,
+        platform=None,
+        term="ondemand",
+        min_price=None,
+        max_price=None,
+        **attributes
+    ):
+        """
+        Return the instances matching all the given criteria, where the ranges
+        include their bounds and memory is in GiB. Other instance attributes are
+        matched by equality, e.g. generation='current'.
+
+        With a region only the instances priced in that region are returned.
+        With a platform as well only those priced for that platform there are,
+        cheapest first, otherwise the instances are in their original order. A
+        platform or price range without a region raises ValueError.
+        """
+        # Look up each criterion in its index and scan the fewest candidates
+        lookups = []
+        if family is not None:
+            lookups.append(self.by_family.get(family, []))
+        if min_vcpu is not None or max_vcpu is not None:
+            lookups.append(self.vcpus.between(min_vcpu, max_vcpu))
+        if min_memory is not None or max_memory is not None:
+            lookups.append(self.memory.between(min_memory, max_memory))
+        if region is not None and platform is None:
+            lookups.append(self.by_region.get(region, []))
+
+        by_price = region is not None and platform is not None
+        if platform is not None and region is None:
+            raise ValueError("A platform needs a region")
+        if by_price:
+            ordered = self.price_index(region, platform, term).between(
+                min_price, max_price
+            )
+        elif min_price is not None or max_price is not None:
+            raise ValueError("A price range needs a region and platform")
+        elif lookups:
+            ordered = min(lookups, key=len)
+            lookups.remove(ordered)
+        else:
+            ordered = range(len(self.instances))
+
+        matches = set.intersection(*[set(p) for p in lookups]) if lookups else None
+        positions = [p for p in ordered if matches is None or p in matches]
+        if not by_price:
+            positions.sort()
+
+        instances = [self.instances[p] for p in positions]
+        if attributes:
+            instances = [
+                i
+                for i in instances
+                if all(i.get(k) == v for k, v in attributes.items())
+            ]
+        return instances
@@ -1,13 +1,76 @@
 #!/usr/bin/env python
 
-import pprint
+import gzip
 import json
+import shutil
 import subprocess
 
 root_dir = (
     subprocess.check_output(["git", "rev-parse", "--show-toplevel"]).decode().strip()
 )
 
+# The services in the package and the data file each one is read from
+SERVICES = {
+    "ec2": "www/instances.json",
+    "rds": "www/rds/instances.json",
+}
+
+# ec2instances/info/__init__.py, which loads the data of a service from its
+# compressed JSON file the first time the service is accessed
+LOADER = '''"""
+Instance data of cloud-instances.info, with a list of instances per service:
+
+    from ec2instances.info import ec2, rds
+
+Each service is only loaded from its compressed JSON file on first access.
+Repeated queries are faster against the indexes of a service:
+
+    from ec2instances.info import index
+
+    index("ec2").find(min_vcpu=16, region="eu-west-1", platform="linux")
+"""
+import gzip
+import json
+import os
+import sys
+import threading
+
+SERVICES = {services!r}
+
+_indexes = {{}}
+_indexes_lock = threading.Lock()
+
+
+def load(service):
+    """Return the instances of a service, read from its data file"""
+    data_file = os.path.join(os.path.dirname(__file__), service + ".json.gz")
+    with gzip.open(data_file, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def index(service):
+    """Return the InstanceIndex of a service, built on first use"""
+    from .query import InstanceIndex
+
+    if service not in SERVICES:
+        raise ValueError("Unknown service {{!r}}".format(service))
+    with _indexes_lock:
+        if service not in _indexes:
+            _indexes[service] = InstanceIndex(getattr(sys.modules[__name__], service))
+        return _indexes[service]
+
+
+def __getattr__(name):
+    if name in SERVICES:
+        instances = globals()[name] = load(name)
+        return instances
+    raise AttributeError("module {{!r}} has no attribute {{!r}}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(SERVICES))
+'''
+
 
 def path(s):
     return "{}/{}".format(root_dir, s)
@@ -19,20 +82,16 @@ subprocess.call(["mkdir", "-p", path("ec2instances/info")])
 subprocess.call(["touch", path("ec2instances/__init__.py")])
 
 
+for service, data_file in SERVICES.items():
+    with open(path(data_file), "r") as input:
+        instances = json.loads(input.read())
+    # mtime=0 keeps the output identical for identical data
+    with gzip.GzipFile(
+        path("ec2instances/info/{}.json.gz".format(service)), "wb", mtime=0
+    ) as output:
+        output.write(json.dumps(instances, separators=(",", ":")).encode("utf-8"))
+
 with open(path("ec2instances/info/__init__.py"), "w+") as output:
-    # Final output will look like the following, though pretty-printed:
-    #
-    #  ec2 = [{'instance_type': 't2.micro', ...}, ...]
-    #  rds = [{'instance_type': 'db.t2.small', ...}, ...]
-    #
-    with open(path("www/instances.json"), "r") as input:
-        ec2 = json.loads(input.read())
-        output.write("ec2 = {}".format(pprint.pformat(ec2)))
-
-    output.write("\n")
-
-    with open(path("www/rds/instances.json"), "r") as input:
-        rds = json.loads(input.read())
-        output.write("rds = {}".format(pprint.pformat(rds)))
-
-    output.write("\n")
+    output.write(LOADER.format(services=tuple(SERVICES)))
+
+shutil.copy(path("scripts/info_query.py"), path("ec2instances/info/query.py"))
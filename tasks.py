@@ -2,14 +2,17 @@
 #   AWS_ACCESS_KEY_ID
 #   AWS_SECRET_ACCESS_KEY
 # as explained in AWS documentation: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/credentials.html
+import concurrent.futures
 import json
 import os
+import sys
+import time
 import traceback
 import mimetypes
 
 import boto3
 import requests
-from invoke import task
+from invoke import Context, task
 from invocations.console import confirm
 from six.moves import SimpleHTTPServer, socketserver
 
@@ -17,9 +20,13 @@ from rds import scrape as rds_scrape
 from cache import scrape as cache_scrape
 from redshift import scrape as redshift_scrape
 from opensearch import scrape as opensearch_scrape
-from render import render
+import http_cache
+from render import render_services
 from render import build_sitemap
 from render import about_page
+from precompress import ENCODINGS, compress_tree, get_variants
+from deploy_manifest import DeployManifest
+from preview_server import PreviewHandler, PreviewServer
 from scrape import scrape
 
 BUCKET_NAME = "www.ec2instances.info"
@@ -56,20 +63,52 @@ def fetch_from_website_and_write_to_file(file_path):
         return None
 
 
-@task
-def build(c, refresh_data=False):
-    """Scrape AWS sources for data and build the site"""
-    scrape_ec2(c, refresh_data)
-    scrape_rds(c, refresh_data)
-    scrape_elasticache(c, refresh_data)
-    scrape_redshift(c, refresh_data)
-    scrape_opensearch(c, refresh_data)
-    render_html(c)
+def validate_data_file(file_path):
+    with open(file_path) as f:
+        json.load(f)
+
+
+def mirror_from_website(file_paths, max_workers=5):
+    """
+    Download data files from the website concurrently, streaming them to disk.
+
+    Files that are unchanged since they were last mirrored aren't downloaded
+    again. Returns the files which are available locally.
+    """
+    session = http_cache.create_session(max_connections=max_workers)
+
+    def mirror_file(file_path):
+        remote_url = f"{REMOTE_WEBSITE_DATA_PREFIX}/{file_path}"
+        local_path = f"www/{file_path}"
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        try:
+            if http_cache.mirror(
+                remote_url, local_path, session, validate=validate_data_file
+            ):
+                print(
+                    f"INFO: data fetched from: {remote_url} and saved to local file: {local_path}"
+                )
+            else:
+                print(f"INFO: local file {local_path} is up to date with {remote_url}")
+            return file_path
+        except requests.exceptions.RequestException as e:
+            print(f"ERROR: Network error while fetching data: {e}")
+        except json.JSONDecodeError as e:
+            print(f"ERROR: Invalid JSON received from {remote_url}: {e}")
+        except Exception as e:
+            print(f"ERROR: Unexpected error: {e}")
+        return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [f for f in executor.map(mirror_file, file_paths) if f is not None]
 
 
 @task
-def scrape_ec2(c, refresh_data):
-    """Scrape EC2 data from AWS and save to local file"""
+def scrape_ec2(c, refresh_data, pricing_source="api"):
+    """Scrape EC2 data from AWS and save to local file
+
+    pricing_source is "api" for the Pricing API or "bulk" for the bulk offer files
+    """
     ec2_file = "instances.json"
     if not refresh_data:
         result = fetch_from_website_and_write_to_file(ec2_file)
@@ -77,13 +116,15 @@ def scrape_ec2(c, refresh_data):
             print("Unable to fetch data, proceed to scrap")
         else:
         # data is fetched from website, no need to scrap aws
-            return
+            return True
 
     try:
-        scrape(ec2_file)
+        scrape(ec2_file, pricing_source=pricing_source)
     except Exception as e:
         print("ERROR: Unable to scrape EC2 data")
         print(traceback.print_exc())
+        return False
+    return True
 
 
 @task
@@ -96,13 +137,15 @@ def scrape_rds(c, refresh_data):
             print("Unable to fetch data, proceed to scrap")
         else:
             # data is fetched from website, no need to scrap aws
-            return
+            return True
 
     try:
         rds_scrape(rds_file)
     except Exception as e:
         print("ERROR: Unable to scrape RDS data")
         print(traceback.print_exc())
+        return False
+    return True
 
 
 @task
@@ -115,13 +158,15 @@ def scrape_elasticache(c, refresh_data):
             print("Unable to fetch data, proceed to scrap")
         else:
             # data is fetched from website, no need to scrap aws
-            return
+            return True
 
     try:
         cache_scrape(elasticache_file)
     except Exception as e:
         print("ERROR: Unable to scrape Cache data")
         print(traceback.print_exc())
+        return False
+    return True
 
 
 @task
@@ -134,13 +179,15 @@ def scrape_redshift(c, refresh_data):
             print("Unable to fetch data, proceed to scrap")
         else:
             # data is fetched from website, no need to scrap aws
-            return
+            return True
 
     try:
         redshift_scrape(redshift_file)
     except Exception as e:
         print("ERROR: Unable to scrape Redshift data")
         print(traceback.print_exc())
+        return False
+    return True
 
 
 @task
@@ -153,16 +200,165 @@ def scrape_opensearch(c, refresh_data):
             print("Unable to fetch data, proceed to scrap")
         else:
             # data is fetched from website, no need to scrap aws
-            return
+            return True
     try:
         opensearch_scrape(opensearch_file)
     except Exception as e:
         print("ERROR: Unable to scrape OpenSearch data")
         print(traceback.print_exc())
+        return False
+    return True
+
+
+# The name, data file relative to www/ and scraper of every service
+SERVICES = [
+    ("EC2", "instances.json", scrape_ec2),
+    ("RDS", "rds/instances.json", scrape_rds),
+    ("ElastiCache", "cache/instances.json", scrape_elasticache),
+    ("Redshift", "redshift/instances.json", scrape_redshift),
+    ("OpenSearch", "opensearch/instances.json", scrape_opensearch),
+]
+
+DATA_FILES = [data_file for _, data_file, _ in SERVICES]
+
+# Services scraped in parallel only once the service they read the data of is
+# done, RDS reads the EC2 specs from www/instances.json
+SCRAPE_AFTER = {"RDS": "EC2"}
+
+
+class PrefixedStream(object):
+    """Write the lines written to it to stream, each one with a prefix"""
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self.partial = ""
+
+    def write(self, s):
+        lines = (self.partial + s).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.stream.write(f"{self.prefix}{line}\n")
+        self.stream.flush()
+        return len(s)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        if self.partial:
+            self.stream.write(f"{self.prefix}{self.partial}\n")
+            self.partial = ""
+        self.stream.flush()
+
+    def isatty(self):
+        return False
+
+
+def scrape_service(c, name, refresh_data, pricing_source):
+    """Run the scraper of a service, returns whether it succeeded"""
+    for service_name, _, scraper in SERVICES:
+        if service_name == name:
+            if scraper is scrape_ec2:
+                return scraper(c, refresh_data, pricing_source)
+            return scraper(c, refresh_data)
+    raise ValueError(f"Unknown service {name!r}")
+
+
+def scrape_service_worker(name, refresh_data, pricing_source):
+    """
+    Scrape a service in a worker process, with the output prefixed by the service
+    name. Returns whether it succeeded and how long it took.
+    """
+    streams = sys.stdout, sys.stderr
+    sys.stdout = PrefixedStream(streams[0], f"[{name}] ")
+    sys.stderr = PrefixedStream(streams[1], f"[{name}] ")
+    start = time.time()
+    try:
+        succeeded = scrape_service(Context(), name, refresh_data, pricing_source)
+    except Exception:
+        traceback.print_exc()
+        succeeded = False
+    finally:
+        sys.stdout.close()
+        sys.stderr.close()
+        sys.stdout, sys.stderr = streams
+    return bool(succeeded), time.time() - start
 
 
 @task
-def serve(c):
+def build(c, refresh_data=False, pricing_source="api", mirror=False, parallel=False):
+    """Scrape AWS sources for data and build the site
+
+    With --mirror the data of all services is downloaded from the website at
+    once, and only the services whose data couldn't be downloaded are scraped.
+    With --parallel the services are scraped at the same time, each in its own
+    process, and the site is rendered once all of them are done. RDS is only
+    started once EC2 is done, as it reads the EC2 specs from its data file.
+    """
+    mirrored = []
+    if mirror and not refresh_data:
+        mirrored = mirror_from_website(DATA_FILES)
+        refresh_data = True
+    names = [name for name, data_file, _ in SERVICES if data_file not in mirrored]
+
+    if not parallel:
+        for name in names:
+            scrape_service(c, name, refresh_data, pricing_source)
+        render_html(c)
+        return
+
+    # Every service gets a pool of its own, so that a scraper process dying
+    # doesn't break the pool the other services are scraped in
+    results = {}
+    executors = []
+    futures = {}
+    pending = set()
+
+    def submit(name):
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        executors.append(executor)
+        future = executor.submit(
+            scrape_service_worker, name, refresh_data, pricing_source
+        )
+        futures[future] = name, time.time()
+        pending.add(future)
+
+    waiting = [name for name in names if SCRAPE_AFTER.get(name) in names]
+    try:
+        for name in names:
+            if name not in waiting:
+                submit(name)
+
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                pending.remove(future)
+                name, submitted = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    print(f"ERROR: Scraper process of {name} failed: {e!r}")
+                    results[name] = False, time.time() - submitted
+            for name in [n for n in waiting if SCRAPE_AFTER[n] in results]:
+                waiting.remove(name)
+                submit(name)
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+    print("Scraped services:")
+    for name in names:
+        succeeded, duration = results[name]
+        status = "ok" if succeeded else "FAILED"
+        print(f"  {name}: {status} in {duration:.1f}s")
+    render_html(c)
+
+
+@task
+def serve(c, preview=False):
     class MyHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         def do_GET(self):
             # The URL does not include ".html". Add it to serve the file for dev
@@ -176,9 +372,16 @@ def serve(c):
             print(self.path)
             SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
 
-    """Serve site contents locally for development"""
+    """Serve site contents locally for development
+
+    With --preview the files are served concurrently from memory, compressed
+    and with ETag and Range support, see preview_server.py.
+    """
     os.chdir("www/")
-    httpd = socketserver.TCPServer((HTTP_HOST, int(HTTP_PORT)), MyHandler)
+    if preview:
+        httpd = PreviewServer((HTTP_HOST, int(HTTP_PORT)), PreviewHandler)
+    else:
+        httpd = socketserver.TCPServer((HTTP_HOST, int(HTTP_PORT)), MyHandler)
     print(
         "Serving on http://{}:{}".format(
             httpd.socket.getsockname()[0], httpd.socket.getsockname()[1]
@@ -188,32 +391,19 @@ def serve(c):
 
 
 @task
-def render_html(c):
-    """Render HTML but do not update data from Amazon"""
-    sitemap = []
-    sitemap.extend(render("www/instances.json", "in/index.html.mako", "www/index.html"))
-    sitemap.extend(
-        render("www/rds/instances.json", "in/rds.html.mako", "www/rds/index.html")
-    )
-    sitemap.extend(
-        render("www/cache/instances.json", "in/cache.html.mako", "www/cache/index.html")
-    )
-    sitemap.extend(
-        render(
-            "www/redshift/instances.json",
-            "in/redshift.html.mako",
-            "www/redshift/index.html",
-        )
-    )
-    sitemap.extend(
-        render(
-            "www/opensearch/instances.json",
-            "in/opensearch.html.mako",
-            "www/opensearch/index.html",
-        )
-    )
+def render_html(c, incremental=False, processes=None):
+    """Render HTML but do not update data from Amazon
+
+    With --incremental, detail pages whose inputs haven't changed since the
+    last render are not rendered again. With --processes N, up to N services
+    are rendered at the same time.
+    """
+    if processes is not None:
+        processes = int(processes)
+    sitemap = render_services(processes=processes, incremental=incremental)
     sitemap.append(about_page())
     build_sitemap(sitemap)
+    compress_tree("www")
 
 
 @task
@@ -279,8 +469,15 @@ def bucket_delete(c):
 
 
 @task
-def deploy(c, root_dir="www", max_workers=30):
-    """Deploy current content to Cloudflare R2 or S3 with parallel uploads"""
+def deploy(c, root_dir="www", max_workers=30, sync=False, delete=False):
+    """
+    Deploy current content to Cloudflare R2 or S3 with parallel uploads
+
+    The hash of each uploaded object is kept in a manifest saved in the bucket,
+    see deploy_manifest.py. With --sync the objects that are unchanged since the
+    last deploy are skipped, and with --delete the objects of earlier deploys
+    whose file is gone are deleted.
+    """
     import concurrent.futures
 
     # Get bucket name from environment variable or use default
@@ -302,12 +499,14 @@ def deploy(c, root_dir="www", max_workers=30):
         )
         # R2 doesn't support ACL
         extra_args_base = {}
+        manifest = DeployManifest(f"r2-{BUCKET_NAME}", s3, BUCKET_NAME)
     else:
         # Using AWS S3
         print(f"Deploying to AWS S3 bucket: {BUCKET_NAME}")
         s3 = boto3.client("s3")
         # S3 requires ACL for public access
         extra_args_base = {"ACL": "public-read"}
+        manifest = DeployManifest(f"s3-{BUCKET_NAME}", s3, BUCKET_NAME)
 
     # Collect all files to upload
     upload_tasks = []
@@ -315,6 +514,9 @@ def deploy(c, root_dir="www", max_workers=30):
         for name in files:
             if name.startswith("."):
                 continue
+            # Precompressed variants are uploaded along with their file
+            if os.path.splitext(name)[1] in ENCODINGS:
+                continue
 
             local_path = os.path.join(root, name)
             remote_path = local_path[len(root_dir) + 1 :]
@@ -323,10 +525,12 @@ def deploy(c, root_dir="www", max_workers=30):
     total_files = len(upload_tasks)
     print(f"Uploading {total_files} files to {BUCKET_NAME}...")
 
-    # Function to handle a single file upload
+    # Function to handle a single file upload. Each body is uploaded once and the
+    # other keys with the same body are returned to be copied from it in the bucket.
     def upload_file(task):
         local_path, remote_path, name = task
         uploads = []
+        copies = []
 
         try:
             # Set content type based on file extension
@@ -371,39 +575,122 @@ def deploy(c, root_dir="www", max_workers=30):
             else:
                 upload_targets = [(remote_path, "Standard")]
 
-            # Upload all versions of the file
-            for target_key, label in upload_targets:
-                s3.upload_file(
-                    Filename=local_path,
-                    Bucket=BUCKET_NAME,
-                    Key=target_key,
-                    ExtraArgs=extra_args,
-                )
-                uploads.append((target_key, label))
+            # Upload the gzip variant written at render time in place of the file,
+            # and the brotli variant next to the file for edges that negotiate it
+            filename = local_path
+            variant_uploads = []
+            for suffix, variant in get_variants(local_path).items():
+                variant_args = dict(extra_args, ContentEncoding=ENCODINGS[suffix])
+                if suffix == ".gz":
+                    filename, extra_args = variant, variant_args
+                else:
+                    variant_uploads.append(
+                        (variant, remote_path + suffix, variant_args)
+                    )
 
-            return local_path, uploads, None
+            # Upload all versions of the file, unless unchanged when syncing
+            objects = [
+                (filename, target_key, extra_args, label)
+                for target_key, label in upload_targets
+            ]
+            for variant, target_key, variant_args in variant_uploads:
+                objects.append((variant, target_key, variant_args, "Precompressed"))
+
+            digests = {}
+            source_keys = {}
+            for source, target_key, args, label in objects:
+                if source not in digests:
+                    digests[source] = manifest.digest(source, args)
+                digest = digests[source]
+                if sync and manifest.is_current(target_key, digest):
+                    uploads.append((target_key, label, digest, "unchanged"))
+                elif source in source_keys:
+                    copies.append(
+                        (source_keys[source], target_key, args, label, digest)
+                    )
+                    continue
+                else:
+                    s3.upload_file(
+                        Filename=source,
+                        Bucket=BUCKET_NAME,
+                        Key=target_key,
+                        ExtraArgs=args,
+                    )
+                    uploads.append((target_key, label, digest, "uploaded"))
+                source_keys.setdefault(source, target_key)
+
+            return local_path, uploads, copies, None
+        except Exception as e:
+            return local_path, None, [], str(e)
+
+    # Function to create an alias key from an uploaded object, the content type and
+    # encoding are copied along with the body
+    def copy_object(local_path, copy):
+        source_key, target_key, args, label, digest = copy
+        try:
+            acl_args = {"ACL": args["ACL"]} if "ACL" in args else {}
+            s3.copy_object(
+                Bucket=BUCKET_NAME,
+                Key=target_key,
+                CopySource={"Bucket": BUCKET_NAME, "Key": source_key},
+                **acl_args,
+            )
+            return local_path, [(target_key, label, digest, "copied")], [], None
         except Exception as e:
-            return local_path, None, str(e)
+            return local_path, None, [], f"{target_key}: {e}"
 
-    # Upload files in parallel
-    success_count = 0
+    # Upload files in parallel, and copy the alias keys of each file in the same
+    # pool once its body is uploaded
+    counts = {"uploaded": 0, "copied": 0, "unchanged": 0}
     error_count = 0
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_task = {
-            executor.submit(upload_file, task): task for task in upload_tasks
-        }
-
-        for future in concurrent.futures.as_completed(future_to_task):
-            local_path, uploads, error = future.result()
-            if error:
-                print(f"ERROR uploading {local_path}: {error}")
-                error_count += 1
-            else:
-                for path, type_label in uploads:
-                    print(f"✓ {local_path} -> {BUCKET_NAME}/{path} ({type_label})")
-                success_count += 1
-    print(f"\nDeployment completed: {success_count} successful, {error_count} failed")
+        pending = {executor.submit(upload_file, task) for task in upload_tasks}
+
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                local_path, uploads, copies, error = future.result()
+                if error:
+                    print(f"ERROR uploading {local_path}: {error}")
+                    error_count += 1
+                    continue
+                for path, type_label, digest, action in uploads:
+                    manifest.update(path, digest)
+                    counts[action] += 1
+                    if action != "unchanged":
+                        print(
+                            f"✓ {local_path} -> {BUCKET_NAME}/{path} ({type_label}, {action})"
+                        )
+                for copy in copies:
+                    pending.add(executor.submit(copy_object, local_path, copy))
+
+    # Objects of earlier deploys which weren't deployed now. These include the
+    # objects of files that failed to upload, so nothing is deleted then.
+    stale_keys = manifest.stale_keys()
+    if delete and stale_keys and error_count:
+        print(f"WARNING: Not deleting {len(stale_keys)} stale objects after failures")
+    elif delete and stale_keys:
+        for i in range(0, len(stale_keys), 1000):
+            s3.delete_objects(
+                Bucket=BUCKET_NAME,
+                Delete={
+                    "Objects": [{"Key": key} for key in stale_keys[i : i + 1000]],
+                    "Quiet": True,
+                },
+            )
+        for key in stale_keys:
+            print(f"✗ {BUCKET_NAME}/{key} (Deleted)")
+        stale_keys = []
+    manifest.save(keep=stale_keys)
+
+    print(
+        f"\nDeployment completed: {counts['uploaded']} uploaded, "
+        f"{counts['copied']} copied, {counts['unchanged']} unchanged, "
+        f"{error_count} failed"
+    )
 
 
 @task(default=True)
@@ -0,0 +1,42 @@
+import hashlib
+import os
+import threading
+
+import mako.lookup
+
+# Compiled templates are kept here between runs, keyed by the hash of their source
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", ".mako_modules")
+
+_lookup = None
+_lookup_lock = threading.Lock()
+
+
+def module_filename(filename, uri):
+    """Path of the compiled module of a template, which changes with its source"""
+    with open(filename, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return os.path.join(
+        TEMPLATE_CACHE_DIR, "{}.{}.py".format(os.path.basename(filename), digest[:16])
+    )
+
+
+def get_lookup():
+    """Return the template lookup shared by every renderer in this process"""
+    global _lookup
+    with _lookup_lock:
+        if _lookup is None:
+            _lookup = mako.lookup.TemplateLookup(
+                directories=["."], modulename_callable=module_filename
+            )
+        return _lookup
+
+
+def get_template(filename):
+    """
+    Return the template at filename, relative to the repository root.
+
+    Each template, including the ones it inherits from, is compiled once per
+    process, and the compiled module is reused by later runs while the source
+    is unchanged.
+    """
+    return get_lookup().get_template(filename)
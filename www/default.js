@@ -344,7 +344,21 @@ $(document).ready(function () {
     g_settings_defaults.default_sort_col = 6;
   }
 
-  init_data_table();
+  // the page may only hold the first rows of the table, see INDEX_INITIAL_ROWS in
+  // render.py. The other rows are added before the table is set up, and it is
+  // set up with the rows at hand should they fail to load.
+  var rows_url = $('#data').data('rows');
+  if (rows_url) {
+    $.get(rows_url, null, null, 'html')
+      .done(function (rows) {
+        $('#data tbody').append(rows);
+      })
+      .always(function () {
+        init_data_table();
+      });
+  } else {
+    init_data_table();
+  }
 });
 
 function change_cost() {
@@ -546,6 +560,66 @@ function change_availability_zones() {
   });
 }
 
+// _pricing holds the columnar pricing of the selected region, see columnar_pricing
+// in render.py for the generation side. The first lookup indexes its rows and
+// columns, and the sparse prices of a row are decoded when it's first looked up.
+var _pricing_indexed = null;
+var _pricing_rows = null;
+var _pricing_columns = null;
+var _pricing_cells = null;
+
+function index_pricing(payload) {
+  _pricing_rows = {};
+  for (var row = 0; row < payload.instances.length; row++) {
+    _pricing_rows[payload.instances[row]] = row;
+  }
+  _pricing_columns = {};
+  for (var column = 0; column < payload.platforms.length; column++) {
+    _pricing_columns[payload.platforms[column] + '/' + payload.terms[column]] = column;
+  }
+  _pricing_cells = [];
+  _pricing_indexed = payload;
+}
+
+function pricing_cells(row) {
+  var cells = _pricing_cells[row];
+  if (cells === undefined) {
+    cells = _pricing_cells[row] = {};
+    var steps = _pricing.prices[row];
+    var column = -1;
+    for (var i = 0; i < steps.length; i += 2) {
+      column += steps[i];
+      cells[column] = steps[i + 1];
+    }
+  }
+  return cells;
+}
+
+function get_pricing(instance_type, region) {
+  if (_pricing_indexed !== _pricing) {
+    index_pricing(_pricing);
+  }
+  if (region !== _pricing.region) {
+    return undefined;
+  }
+  var path = [];
+  for (var i = 2; i < arguments.length; i++) {
+    if (arguments[i] === 'none') {
+      // this is for services like Redshift and OpenSearch which
+      // do not have multiple 'platforms'. RDS for example has 20
+      // OS's, and ElastiCache has Memcached and Redis
+      continue;
+    }
+    path.push(arguments[i]);
+  }
+  var row = _pricing_rows[instance_type];
+  var column = _pricing_columns[path[0] + '/' + path.slice(1).join('/')];
+  if (row === undefined || column === undefined) {
+    return undefined;
+  }
+  return pricing_cells(row)[column];
+}
+
 function change_region(region, called_on_init) {
   if (called_on_init && region === 'us-east-1') {
     // Don't load pricing data on initial page load. It's already there.
@@ -567,7 +641,7 @@ function change_region(region, called_on_init) {
   }
 
   // Construct the file paths by joining components
-  var prices_path = new URL('pricing_' + region + '.json', origin + currentPath).href;
+  var prices_path = new URL('pricing_columnar_' + region + '.json', origin + currentPath).href;
   var azs_path = new URL('instance_azs_' + region + '.json', origin + currentPath).href;
 
   Promise.all([